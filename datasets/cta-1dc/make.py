@@ -1,51 +1,137 @@
 """Copy some of the 1DC files that we use for tests and tutorials.
+
+By default (``--mode auto``) files are cloned with a reflink (copy-on-write)
+or hard-linked if ``$CTADATA`` is on the same filesystem, and copied in
+parallel otherwise. Hard-linked files share the data with ``$CTADATA``,
+so they must not be modified in place. Use ``--dry-run`` to only print
+what would be done and the total size.
 """
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import argparse
+import errno
 import os
 import shutil
-import numpy as np
-from astropy.table import Table
+import sys
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from obs_index import subset_index_tables  # noqa: E402
 
 CTADATA = Path(os.environ['CTADATA'])
 # OBS_ID=111630 is for Vela PSR with PHASE
 obs_ids = [110380, 111140, 111159, 111630]
 
 
-def make_obs_index():
-    filename = CTADATA / 'index/gps/obs-index.fits.gz'
-    table = Table.read(filename)
-    mask = np.array([_ in obs_ids for _ in table['OBS_ID']])
-    table = table[mask]
+def make_index_tables():
+    subset_index_tables(CTADATA / 'index/gps', 'index/gps', obs_ids)
+
+
+COPY_MODES = ['auto', 'reflink', 'hardlink', 'symlink', 'copy']
+
+# ioctl request to clone a file (Linux, e.g. btrfs, XFS)
+FICLONE = 0x40049409
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY, errno.EPERM)
+
+
+def reflink(src, dst):
+    """Copy-on-write clone of ``src``, raises `OSError` if not supported."""
+    import fcntl
+
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        except OSError:
+            os.unlink(dst)
+            raise
+
+
+def get_methods(src, dst, mode):
+    """Methods to try for copying ``src`` to ``dst``, in order."""
+    if mode != 'auto':
+        return [mode]
+
+    # nearest existing folder, the output folders are only created for a real copy
+    parent = Path(dst).parent
+    while not parent.exists():
+        parent = parent.parent
+    same_fs = os.stat(src).st_dev == os.stat(parent).st_dev
+    return ['reflink', 'hardlink', 'copy'] if same_fs else ['copy']
 
-    filename = 'index/gps/obs-index.fits.gz'
-    print(f'Writing {filename}')
-    table.write(filename, overwrite=True)
 
+def copy_file(src, dst, mode='auto'):
+    """Copy, clone or link ``src`` to ``dst``.
 
-def make_hdu_index():
-    filename = CTADATA / 'index/gps/hdu-index.fits.gz'
-    table = Table.read(filename)
-    mask = np.array([_ in obs_ids for _ in table['OBS_ID']])
-    table = table[mask]
+    Returns
+    -------
+    method : str
+        Method used.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
 
-    filename = 'index/gps/hdu-index.fits.gz'
-    print(f'Writing {filename}')
-    table.write(filename, overwrite=True)
+    methods = get_methods(src, dst, mode)
+    for method in methods:
+        try:
+            if method == 'reflink':
+                reflink(src, dst)
+            elif method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'symlink':
+                os.symlink(Path(src).resolve(), dst)
+            else:
+                shutil.copy(src, dst)
+            return method
+        except OSError as exc:
+            # Only fall back to the next method if this one isn't supported
+            if method == methods[-1] or exc.errno not in UNSUPPORTED_ERRNOS:
+                raise
 
 
-def copy_caldb():
+def copy_files(files, mode='auto', n_jobs=8, dry_run=False):
+    """Copy list of ``(src, dst)`` files, in parallel.
+
+    The output folders are created as needed. With ``dry_run=True`` only
+    the methods that would be tried and the total size are printed, and
+    nothing is written.
+    """
+    size = sum(os.stat(src).st_size for src, _ in files)
+
+    if dry_run:
+        for src, dst in files:
+            methods = get_methods(src, dst, mode)
+            print(f'{" or ".join(methods)} {src} {dst}')
+        print(f'Total size: {size / 1e9:.3f} GB in {len(files)} files')
+        return
+
+    for folder in sorted({Path(dst).parent for _, dst in files}):
+        folder.mkdir(exist_ok=True, parents=True)
+
+    def _copy(args):
+        src, dst = args
+        method = copy_file(src, dst, mode)
+        print(f'{method} {src} {dst}')
+        return method
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        methods = list(executor.map(_copy, files))
+
+    size_copied = sum(
+        os.stat(src).st_size for (src, _), method in zip(files, methods) if method == 'copy'
+    )
+    print(f'Total size: {size / 1e9:.3f} GB, copied: {size_copied / 1e9:.3f} GB')
+
+
+def get_caldb_files():
     path = Path('caldb/data/cta/1dc/bcf/South_z20_50h')
-    path.mkdir(exist_ok=True, parents=True)
     src = CTADATA / path / 'irf_file.fits'
     dst = path / 'irf_file.fits'
-    print(f'cp {src} {dst}')
-    shutil.copy(str(src), str(dst))
+    return [(src, dst)]
 
 
-def copy_data():
+def get_data_files():
     path = Path('data/baseline/gps')
-    path.mkdir(exist_ok=True, parents=True)
 
+    files = []
     for obs_id in obs_ids:
         # Don't copy / replace the Vela PSR file
         # It was added by Marion here:
@@ -57,17 +143,23 @@ def copy_data():
         filename = path / f'gps_baseline_{obs_id:06d}.fits'
         src = CTADATA / filename
         dst = filename
-        print(f'cp {src} {dst}')
-        shutil.copy(src, dst)
+        files.append((src, dst))
+
+    return files
+
 
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--mode', choices=COPY_MODES, default='auto', help='Copy mode')
+    parser.add_argument('--jobs', type=int, default=8, help='Number of parallel copies')
+    parser.add_argument('--dry-run', action='store_true', help='Only print what would be done')
+    args = parser.parse_args(args)
 
-def main():
-    Path('index/gps').mkdir(exist_ok=True, parents=True)
-    make_obs_index()
-    make_hdu_index()
+    if not args.dry_run:
+        make_index_tables()
 
-    copy_caldb()
-    copy_data()
+    files = get_caldb_files() + get_data_files()
+    copy_files(files, mode=args.mode, n_jobs=args.jobs, dry_run=args.dry_run)
 
 
 if __name__ == '__main__':
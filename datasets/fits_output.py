@@ -0,0 +1,133 @@
+"""Output file format options shared by the dataset ``make.py`` scripts.
+
+The format is selected globally with environment variables:
+
+* ``FITS_COMPRESSION`` : ``gzip`` (default, ``.fits.gz`` files),
+  ``none`` (plain ``.fits`` files) or ``tile`` (``.fits`` files with
+  tile-compressed image HDUs, which can be decompressed individually).
+* ``FITS_GZIP_LEVEL`` : gzip compression level for ``gzip`` (default 9).
+* ``FITS_TILE_COMPRESSION`` : tile compression algorithm for ``tile``
+  (default ``GZIP_2``, which is lossless also for float data).
+
+Tile compression is only defined for images. Binary tables (e.g. the
+DL3 event lists and IRFs) are written uncompressed in ``tile`` mode.
+Tile-compressed images are stored in extensions, so in ``tile`` mode the
+primary HDU is always empty: an image in the primary HDU is moved to the
+first extension, with the same name (``PRIMARY`` if it has no ``EXTNAME``)
+and header keywords. Readers of the default extension 0 (e.g.
+`astropy.io.fits.getheader`, ``SkyImage.read`` of gammapy) get the empty
+primary HDU there, so read images with `read_image_hdus`, which works for
+all formats.
+"""
+import gzip
+import io
+import os
+from pathlib import Path
+from astropy.io import fits
+
+__all__ = [
+    "COMPRESSIONS",
+    "COMPRESSION",
+    "GZIP_LEVEL",
+    "TILE_COMPRESSION_TYPE",
+    "get_filename",
+    "to_bytes",
+    "compress",
+    "write",
+    "read_image_hdus",
+]
+
+COMPRESSIONS = ["gzip", "none", "tile"]
+COMPRESSION = os.environ.get("FITS_COMPRESSION", "gzip")
+GZIP_LEVEL = int(os.environ.get("FITS_GZIP_LEVEL", 9))
+TILE_COMPRESSION_TYPE = os.environ.get("FITS_TILE_COMPRESSION", "GZIP_2")
+
+if COMPRESSION not in COMPRESSIONS:
+    raise ValueError(f"Invalid FITS_COMPRESSION: {COMPRESSION!r}")
+
+
+def get_filename(stem, compression=COMPRESSION):
+    """Filename for a given file stem, e.g. ``counts`` -> ``counts.fits.gz``."""
+    suffix = ".fits.gz" if compression == "gzip" else ".fits"
+    return f"{stem}{suffix}"
+
+
+def _tile_compress(hdu_list):
+    """Convert image HDUs to tile-compressed image HDUs.
+
+    Compressed images can't be stored in the primary HDU, so the output
+    starts with an empty primary HDU (with the keywords of an empty input
+    primary HDU) and an input primary image becomes the first extension.
+    """
+    hdus = [fits.PrimaryHDU()]
+    for hdu in hdu_list:
+        is_image = isinstance(hdu, (fits.PrimaryHDU, fits.ImageHDU))
+        if is_image and hdu.data is not None:
+            # keep the name, else a primary image would be called COMPRESSED_IMAGE
+            hdu = fits.CompImageHDU(
+                data=hdu.data,
+                header=hdu.header,
+                name=hdu.name,
+                compression_type=TILE_COMPRESSION_TYPE,
+                quantize_level=0,
+            )
+        elif isinstance(hdu, fits.PrimaryHDU):
+            # Empty primary, replaced by the new one
+            hdus[0].header.extend(hdu.header, strip=True, update=True)
+            continue
+        hdus.append(hdu)
+    return fits.HDUList(hdus)
+
+
+def to_bytes(hdu_list, compression=COMPRESSION):
+    """Serialise HDU list to (not gzipped) FITS file content."""
+    if compression == "tile":
+        hdu_list = _tile_compress(hdu_list)
+    buffer = io.BytesIO()
+    hdu_list.writeto(buffer)
+    return buffer.getvalue()
+
+
+def compress(data, compression=COMPRESSION, gzip_level=GZIP_LEVEL):
+    """Compress FITS file content for writing.
+
+    For ``gzip`` a fixed ``mtime`` is used, so that output files
+    (and their checksums) are reproducible.
+    """
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=gzip_level, mtime=0)
+    return data
+
+
+def write(hdu_list, stem, compression=COMPRESSION, gzip_level=GZIP_LEVEL):
+    """Write HDU list in the selected output format.
+
+    Returns
+    -------
+    path : `~pathlib.Path`
+        Path of the written file.
+    """
+    path = Path(get_filename(stem, compression))
+    content = compress(to_bytes(hdu_list, compression), compression, gzip_level)
+    # Write to a temp file and rename, so that an interrupted
+    # run never leaves a truncated file at the final location.
+    path_tmp = path.parent / f".{path.name}"
+    path_tmp.write_bytes(content)
+    path_tmp.replace(path)
+    return path
+
+
+def read_image_hdus(filename):
+    """Read the image HDUs with data of a file written by `write`, in order.
+
+    HDUs without data, i.e. the empty primary HDU in ``tile`` mode, are
+    skipped, so the result is the same for all formats.
+
+    Returns
+    -------
+    hdus : list
+        Image HDUs (``PrimaryHDU``, ``ImageHDU`` or ``CompImageHDU``).
+    """
+    image_types = (fits.PrimaryHDU, fits.ImageHDU, fits.CompImageHDU)
+    hdu_list = fits.open(str(filename))
+    return [_ for _ in hdu_list if isinstance(_, image_types) and _.data is not None]
@@ -0,0 +1,95 @@
+"""Benchmark read latency of hess-dl3-dr1 files for different output formats.
+
+The data files in this folder are re-encoded into temporary copies
+(gzip with different levels and uncompressed) and the time to load
+``events``, ``aeff`` and ``bkg`` via `~gammapy.data.DataStore` is measured.
+
+Tile compression is not included: it only applies to images and
+all HDUs in DL3 files are binary tables.
+
+python benchmark_compression.py --n-obs 10
+"""
+import argparse
+import gzip
+import shutil
+import sys
+import tempfile
+import timeit
+from pathlib import Path
+import numpy as np
+from astropy.table import Table
+from gammapy.data import DataStore
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fits_output  # noqa: E402
+
+PATH = Path(__file__).resolve().parent
+
+VARIANTS = {
+    "gzip-9": ("gzip", 9),
+    "gzip-6": ("gzip", 6),
+    "gzip-1": ("gzip", 1),
+    "none": ("none", None),
+}
+HDU_TYPES = ["events", "aeff", "bkg"]
+
+
+def make_variant(path, obs_ids, compression, gzip_level):
+    """Write copy of the dataset for the given OBS_IDs and output format."""
+    (path / "data").mkdir(parents=True)
+    shutil.copyfile(PATH / "obs-index.fits.gz", path / "obs-index.fits.gz")
+
+    table = Table.read(PATH / "hdu-index.fits.gz")
+    table = table[np.isin(table["OBS_ID"], obs_ids)]
+
+    filenames = {}
+    for filename in np.unique(table["FILE_NAME"]):
+        stem = filename[: -len(".fits.gz")]
+        filenames[filename] = fits_output.get_filename(stem, compression)
+        data = gzip.decompress((PATH / "data" / filename).read_bytes())
+        content = fits_output.compress(data, compression, gzip_level)
+        (path / "data" / filenames[filename]).write_bytes(content)
+
+    table["FILE_NAME"] = [filenames[_] for _ in table["FILE_NAME"]]
+    table.write(path / "hdu-index.fits.gz")
+
+
+def time_reads(path, obs_ids, repeat):
+    """Best time (over ``repeat``) to load each HDU type, per observation."""
+    data_store = DataStore.from_dir(path)
+    times = {}
+    for hdu_type in HDU_TYPES:
+
+        def load():
+            for obs_id in obs_ids:
+                getattr(data_store.obs(obs_id), hdu_type)
+
+        times[hdu_type] = min(timeit.repeat(load, number=1, repeat=repeat))
+        times[hdu_type] /= len(obs_ids)
+    return times
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--n-obs", type=int, default=10, help="Number of OBS_IDs")
+    parser.add_argument("--repeat", type=int, default=3, help="Timing repeats")
+    args = parser.parse_args(args)
+
+    obs_ids = Table.read(PATH / "obs-index.fits.gz")["OBS_ID"][: args.n_obs]
+
+    print(f"{'variant':10s} {'size [MB]':>10s}", end="")
+    print("".join(f" {_ + ' [ms]':>12s}" for _ in HDU_TYPES))
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, (compression, gzip_level) in VARIANTS.items():
+            path = Path(tmpdir) / name
+            make_variant(path, obs_ids, compression, gzip_level)
+            size = sum(_.stat().st_size for _ in (path / "data").iterdir())
+            times = time_reads(path, obs_ids, args.repeat)
+
+            print(f"{name:10s} {size / 1e6:10.1f}", end="")
+            print("".join(f" {1e3 * times[_]:12.1f}" for _ in HDU_TYPES))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,20 +2,52 @@
 
 You have to download the data and background models
 and set the `PATH` variables at the top, then run `make.py`
+
+Data files are processed in parallel (see ``--jobs``). Every finished
+OBS_ID is recorded in a manifest file, so that an interrupted run picks
+up where it stopped. Use ``--force`` to rebuild all data files.
+
+The output file format (gzip level, uncompressed) is set with
+``--compression`` and ``--gzip-level``, see ``datasets/fits_output.py``.
 """
+import argparse
+import gzip
+import hashlib
+import io
+import json
 import logging
+import re
 import shutil
+import sys
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 from astropy.io import fits
+from astropy.io.fits.column import KEYWORD_NAMES
 from astropy.table import Table
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+import fits_output  # noqa: E402
+
 log = logging.getLogger(__name__)
 
 PATH_DATA = Path("/Users/deil/work/data/hess/hess-dl3-dr1")
 PATH_BKG = Path("/Users/deil/work/code/hess_ost_paper_material/background_model")
 PATH_OUT = Path(".")
 
+PATH_MANIFEST = PATH_OUT / "make-manifest.jsonl"
+
+# Column keywords (TTYPEn, TSCALn, ...) and the heap offset, these describe
+# the input columns and must not be copied to the recast float32 columns
+COLUMN_KEYWORDS = re.compile(r"^(({})\d+|THEAP)$".format("|".join(KEYWORD_NAMES)))
+
 DEBUG_RUN = False
+N_JOBS = 1
+
+
+def get_filename(obs_id, compression=fits_output.COMPRESSION):
+    stem = f"hess_dl3_dr1_obs_id_{obs_id:06d}"
+    return fits_output.get_filename(stem, compression)
 
 
 def get_obs_ids():
@@ -31,15 +63,57 @@ def make_obs_index():
     shutil.copyfile(src, dst)
 
 
+def get_hdu_size(record, hdu_name):
+    """Get HDU size in bytes from a manifest record.
+
+    Sizes are recorded by `make_data_file` at write time, the data
+    file is only re-opened for records from older manifests.
+    """
+    try:
+        return record["hdu_sizes"][hdu_name]
+    except KeyError:
+        filename = record.get("filename", get_filename(record["obs_id"]))
+        return fits.open(PATH_OUT / f"data/{filename}")[hdu_name].filebytes()
+
+
+def get_records(obs_ids):
+    """Get manifest records for the given OBS_IDs, see `read_manifest`.
+
+    OBS_IDs missing from the manifest (e.g. data files made before the
+    manifest was introduced) are logged and get a record with only the
+    OBS_ID, so that their data file in the default format is read.
+    """
+    records = read_manifest()
+    missing = [int(_) for _ in obs_ids if int(_) not in records]
+    if missing:
+        log.warning(f"OBS_IDs not in {PATH_MANIFEST}, reading data files: {missing}")
+    return {int(_): records.get(int(_), {"obs_id": int(_)}) for _ in obs_ids}
+
+
 def make_hdu_index():
-    """Copy existing HDU index file, add background HDU rows."""
+    """Copy existing HDU index file, add background HDU rows.
+
+    The background HDU sizes are taken from the manifest, so the
+    data files don't have to be re-opened (and decompressed).
+    File names are updated to the output format of the data files.
+    The index is rebuilt from scratch on every run, it only takes
+    the manifest and the input index table.
+    """
     log.info("Make hdu-index.fits.gz")
     path = PATH_DATA / "hdu-index.fits.gz"
     table = Table.read(path)
+    obs_ids = get_obs_ids()
+    records = get_records(obs_ids)
+
+    table["FILE_NAME"] = [
+        records.get(int(obs_id), {}).get("filename", filename)
+        for obs_id, filename in zip(table["OBS_ID"], table["FILE_NAME"])
+    ]
 
-    for obs_id in get_obs_ids():
-        filename = f"hess_dl3_dr1_obs_id_{obs_id:06d}.fits.gz"
-        size = fits.open(PATH_OUT / f"data/{filename}")["bkg"].filebytes()
+    for obs_id in obs_ids:
+        record = records[int(obs_id)]
+        filename = record.get("filename", get_filename(obs_id))
+        size = get_hdu_size(record, "bkg")
         table.add_row([obs_id, "bkg", "bkg_3d", "data", filename, "bkg", size])
 
     table.sort(["OBS_ID", "HDU_TYPE"])
@@ -49,44 +123,245 @@ def make_hdu_index():
     table.write(path, overwrite=True)
 
 
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def get_hdu_checksums(data):
+    """Compute SHA256 checksum of each HDU (header and data block).
+
+    Parameters
+    ----------
+    data : bytes
+        Uncompressed FITS file content.
+
+    Returns
+    -------
+    checksums : dict
+        Checksums keyed by HDU name.
+    """
+    checksums = {}
+    with fits.open(io.BytesIO(data)) as hdu_list:
+        for hdu in hdu_list:
+            info = hdu.fileinfo()
+            start, stop = info["hdrLoc"], info["datLoc"] + info["datSpan"]
+            checksums[hdu.name] = sha256(data[start:stop])
+    return checksums
+
+
+def get_file_checksums(path):
+    """Compute SHA256 checksum of the file and of each HDU."""
+    content = path.read_bytes()
+    data = gzip.decompress(content) if path.suffix == ".gz" else content
+    return {"sha256": sha256(content), "hdus": get_hdu_checksums(data)}
+
+
+def make_checksums():
+    """Write checksums of index and data files to ``checksums.json``.
+
+    Data file checksums are taken from the manifest, they are
+    computed by `make_data_file` at write time.
+    """
+    checksums = {}
+    for filename in ["obs-index.fits.gz", "hdu-index.fits.gz"]:
+        checksums[filename] = get_file_checksums(PATH_OUT / filename)
+
+    obs_ids = get_obs_ids()
+    records = get_records(obs_ids)
+    for obs_id in obs_ids:
+        record = records[int(obs_id)]
+        filename = "data/" + record.get("filename", get_filename(obs_id))
+        if "checksums" in record:
+            checksums[filename] = record["checksums"]
+        else:
+            checksums[filename] = get_file_checksums(PATH_OUT / filename)
+
+    path = PATH_OUT / "checksums.json"
+    log.info(f"Writing {path}")
+    with path.open("w") as fh:
+        json.dump(checksums, fh, indent=2)
+        fh.write("\n")
+
+
 def make_background_hdu(obs_id):
-    """Make background HDU, basically copy, but change to float32."""
+    """Make background HDU, basically copy, but change to float32.
+
+    The output table is allocated once and filled column by column,
+    so apart from the input HDU at most one column is copied at a time.
+    """
     path = PATH_BKG / f"data/hess_bkg_3d_{obs_id:06d}.fits.gz"
-    table = Table.read(path)
 
-    for colname in table.colnames:
-        table[colname] = table[colname].astype("float32")
+    with fits.open(path, memmap=True) as hdu_list:
+        hdu_in = hdu_list[1]
+        columns = [
+            fits.Column(
+                name=col.name,
+                format=f"{col.format.repeat}E",
+                unit=col.unit,
+                dim=col.dim,
+            )
+            for col in hdu_in.columns
+        ]
+        hdu = fits.BinTableHDU.from_columns(columns, nrows=hdu_in.header["NAXIS2"])
+
+        for col in hdu_in.columns:
+            # Casts into the pre-allocated float32 buffer, no extra copy
+            hdu.data[col.name][...] = hdu_in.data[col.name]
+
+        for card in hdu_in.header.cards:
+            keyword = card.keyword
+            if keyword not in hdu.header and not COLUMN_KEYWORDS.match(keyword):
+                hdu.header.append(card)
 
-    hdu = fits.BinTableHDU(table)
     hdu.name = "bkg"
 
     return hdu
 
 
-def make_data_file(obs_id):
+def make_data_file(
+    obs_id, compression=fits_output.COMPRESSION, gzip_level=fits_output.GZIP_LEVEL
+):
     """Copy existing data file, add background HDU."""
     log.info(f"Make data file for OBS_ID = {obs_id}")
     path = PATH_DATA / f"data/hess_dl3_dr1_obs_id_{obs_id:06d}.fits.gz"
     hdu_list = fits.open(path)
 
+    tracemalloc.start()
     hdu_bkg = make_background_hdu(obs_id)
+    _, bkg_peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    log.info(f"Background HDU peak memory: {bkg_peak_memory / 1e6:.1f} MB")
+
     hdu_list.append(hdu_bkg)
 
-    path = PATH_OUT / f"data/hess_dl3_dr1_obs_id_{obs_id:06d}.fits.gz"
+    # Serialise in memory, so that checksums can be computed
+    # without reading back and decompressing the written file.
+    data = fits_output.to_bytes(hdu_list, compression)
+    content = fits_output.compress(data, compression, gzip_level)
+
+    filename = get_filename(obs_id, compression)
+    path = PATH_OUT / f"data/{filename}"
     log.info(f"Writing {path}")
-    hdu_list.writeto(path, overwrite=True)
+    # Write to a temp file and rename, so that an interrupted
+    # run never leaves a truncated file at the final location.
+    path_tmp = path.parent / f".{path.name}"
+    path_tmp.write_bytes(content)
+    path_tmp.replace(path)
+
+    hdu_sizes = {"bkg": hdu_bkg.filebytes()}
+    checksums = {"sha256": sha256(content), "hdus": get_hdu_checksums(data)}
+    return {
+        "obs_id": int(obs_id),
+        "filename": filename,
+        "hdu_sizes": hdu_sizes,
+        "bkg_peak_memory": bkg_peak_memory,
+        "checksums": checksums,
+    }
+
+
+def read_manifest():
+    """Read manifest of finished data files (dict keyed by OBS_ID)."""
+    records = {}
+    if PATH_MANIFEST.exists():
+        with PATH_MANIFEST.open() as fh:
+            for line in fh:
+                # A partially written last line is from an interrupted run
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record["obs_id"]] = record
+    return records
 
 
-def main():
+def make_data_files(
+    n_jobs=N_JOBS,
+    force=False,
+    obs_ids_changed=None,
+    compression=fits_output.COMPRESSION,
+    gzip_level=fits_output.GZIP_LEVEL,
+):
+    """Make all data files, skipping OBS_IDs already in the manifest.
+
+    OBS_IDs listed in ``obs_ids_changed`` are always re-made; their new
+    manifest records supersede the old ones. When changing the output
+    format, use ``force=True`` so that all files are re-made.
+
+    If data files fail, the other ones are still made and recorded, and
+    a `RuntimeError` listing the failed OBS_IDs is raised at the end, so
+    that a re-run only makes the failed ones.
+    """
+    (PATH_OUT / "data").mkdir(exist_ok=True)
+
+    if force and PATH_MANIFEST.exists():
+        PATH_MANIFEST.unlink()
+
+    done = read_manifest()
+    for obs_id in obs_ids_changed or []:
+        done.pop(obs_id, None)
+
+    obs_ids = [int(_) for _ in get_obs_ids() if int(_) not in done]
+    log.info(f"Making {len(obs_ids)} data files ({len(done)} done already)")
+
+    with PATH_MANIFEST.open("a") as fh:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = {
+                executor.submit(make_data_file, _, compression, gzip_level): _
+                for _ in obs_ids
+            }
+            errors = {}
+            for future in as_completed(futures):
+                try:
+                    record = future.result()
+                except Exception as exc:
+                    log.exception(f"Data file for OBS_ID = {futures[future]} failed")
+                    errors[futures[future]] = exc
+                    continue
+                fh.write(json.dumps(record) + "\n")
+                fh.flush()
+
+    if errors:
+        obs_ids_failed = sorted(errors)
+        error = errors[obs_ids_failed[0]]
+        raise RuntimeError(f"Data files failed for OBS_IDs {obs_ids_failed}") from error
+
+
+def main(args=None):
     """Combine data release and background models, update index tables."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--jobs", type=int, default=N_JOBS, help="Number of worker processes"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="Ignore manifest, rebuild all files"
+    )
+    parser.add_argument(
+        "--obs-id", type=int, nargs="+", help="Re-make data files for these OBS_IDs"
+    )
+    parser.add_argument(
+        "--compression",
+        choices=fits_output.COMPRESSIONS,
+        default=fits_output.COMPRESSION,
+        help="Data file format (tables are never tile compressed)",
+    )
+    parser.add_argument(
+        "--gzip-level", type=int, default=fits_output.GZIP_LEVEL, help="gzip level"
+    )
+    args = parser.parse_args(args)
+
     logging.basicConfig(level=logging.INFO)
 
-    (PATH_OUT / "data").mkdir(exist_ok=True)
-    for obs_id in get_obs_ids():
-        make_data_file(obs_id)
+    make_data_files(
+        n_jobs=args.jobs,
+        force=args.force,
+        obs_ids_changed=args.obs_id,
+        compression=args.compression,
+        gzip_level=args.gzip_level,
+    )
 
     make_obs_index()
     make_hdu_index()
+    make_checksums()
 
 
 if __name__ == "__main__":
@@ -2,8 +2,14 @@
 
 pytest test.py
 """
+import gzip
+import hashlib
+import json
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import pytest
 from gammapy.data import DataStore
+from make import get_hdu_checksums
 
 
 @pytest.fixture(scope="session")
@@ -11,8 +17,48 @@ def data_store():
     return DataStore.from_dir(".")
 
 
-def test_checksums():
-    assert 1 == 1
+@pytest.fixture(scope="session")
+def checksums():
+    with open("checksums.json") as fh:
+        return json.load(fh)
+
+
+def get_sha256(filename, chunk_size=2 ** 20):
+    """SHA256 of the raw file bytes (no decompression, no FITS parsing)."""
+    sha256 = hashlib.sha256()
+    with open(filename, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def get_bad_hdus(filename, expected):
+    """List HDUs with checksum mismatch, to make failures easy to debug.
+
+    Files written with ``--compression gzip`` are decompressed (checked with
+    the gzip magic bytes), uncompressed and tile compressed files are used as is.
+    """
+    data = Path(filename).read_bytes()
+    if data[:2] == b"\x1f\x8b":
+        data = gzip.decompress(data)
+    actual = get_hdu_checksums(data)
+    names = set(actual) | set(expected["hdus"])
+    return sorted(_ for _ in names if actual.get(_) != expected["hdus"].get(_))
+
+
+def test_checksums(checksums):
+    assert len(checksums) == 105 + 2
+
+    # hashlib releases the GIL, so threads are enough to use all cores
+    with ThreadPoolExecutor() as executor:
+        actual = dict(zip(checksums, executor.map(get_sha256, checksums)))
+
+    bad = {
+        filename: get_bad_hdus(filename, expected)
+        for filename, expected in checksums.items()
+        if actual[filename] != expected["sha256"]
+    }
+    assert bad == {}
 
 
 def test_index_tables(data_store):
@@ -0,0 +1,207 @@
+"""Cached selection index for observation index tables.
+
+Scripts in this folder select observations from ``obs-index.fits.gz``
+files by pointing position (cone around a target) or by OBS_ID. For large
+index tables (e.g. the full CTA 1DC GPS index) `ObsIndexCache` answers
+these queries in vectorised form and keeps the required arrays in a cache
+file next to the index file, so that repeated selections don't have to
+rebuild `~astropy.coordinates.SkyCoord` objects from the full table.
+
+`subset_index_tables` cuts consistent subsets of the obs and HDU index
+tables for a list of OBS_IDs, it can also be used from the command line::
+
+    python obs_index.py $CTADATA/index/gps index/gps --obs-id 110380 111140
+"""
+import argparse
+import logging
+from pathlib import Path
+import numpy as np
+from astropy.coordinates import Angle
+from astropy.table import Table
+from scipy.spatial import cKDTree
+
+__all__ = ["ObsIndexCache", "subset_index_tables"]
+
+log = logging.getLogger(__name__)
+
+
+def _unit_vectors(lon, lat):
+    lon, lat = np.radians(lon), np.radians(lat)
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+class ObsIndexCache:
+    """Spatial and OBS_ID index for an observation index table.
+
+    Pointing positions are stored as unit vectors in a KD-tree, so a cone
+    query is a ball query with the chord length ``2 sin(radius / 2)``.
+    OBS_ID membership is a binary search in the sorted requested IDs.
+
+    Rows are numbered as in the index table, so results can be used to
+    mask a `~astropy.table.Table` read from the same file.
+
+    Parameters
+    ----------
+    obs_id : `~numpy.ndarray`
+        Observation IDs.
+    ra, dec : `~numpy.ndarray`
+        Pointing positions (ICRS, deg).
+    """
+
+    def __init__(self, obs_id, ra, dec):
+        self.obs_id = np.asarray(obs_id, dtype=np.int64)
+        self.ra = np.asarray(ra, dtype=np.float64)
+        self.dec = np.asarray(dec, dtype=np.float64)
+        self._tree = cKDTree(_unit_vectors(self.ra, self.dec))
+
+    def __len__(self):
+        return len(self.obs_id)
+
+    @staticmethod
+    def cache_path(filename):
+        """Cache file name for a given index file."""
+        path = Path(filename)
+        return path.with_name(path.name + ".cache.npz")
+
+    @classmethod
+    def from_table(cls, table):
+        """Create from obs index table (``OBS_ID``, ``RA_PNT``, ``DEC_PNT``)."""
+        return cls(table["OBS_ID"], table["RA_PNT"], table["DEC_PNT"])
+
+    @classmethod
+    def read(cls, filename):
+        """Read from cache file, or build from the index file and cache it.
+
+        The cache is rebuilt when size or modification time of the index
+        file don't match. If the cache can't be written (e.g. read-only
+        data folder), the index is still returned.
+        """
+        path = Path(filename)
+        cache_path = cls.cache_path(path)
+        stat = path.stat()
+        key = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+        if cache_path.exists():
+            with np.load(cache_path) as data:
+                if np.array_equal(data["key"], key):
+                    return cls(data["obs_id"], data["ra"], data["dec"])
+
+        log.info(f"Building obs index cache for {path}")
+        index = cls.from_table(Table.read(path))
+        try:
+            np.savez(
+                cache_path, key=key, obs_id=index.obs_id, ra=index.ra, dec=index.dec
+            )
+        except OSError as exc:
+            log.warning(f"Could not write {cache_path}: {exc}")
+        return index
+
+    def select_cone(self, position, radius):
+        """Rows with pointing within ``radius`` of ``position``.
+
+        Parameters
+        ----------
+        position : `~astropy.coordinates.SkyCoord`
+            Cone center.
+        radius : `~astropy.coordinates.Angle`
+            Cone radius.
+
+        Returns
+        -------
+        mask : `~numpy.ndarray`
+            Boolean row mask.
+        """
+        icrs = position.icrs
+        vector = _unit_vectors(icrs.ra.deg, icrs.dec.deg)[0]
+        chord = 2 * np.sin(Angle(radius).rad / 2)
+        mask = np.zeros(len(self), dtype=bool)
+        mask[self._tree.query_ball_point(vector, chord)] = True
+        return mask
+
+    def select_obs_id(self, obs_ids):
+        """Rows with one of the given OBS_IDs.
+
+        Parameters
+        ----------
+        obs_ids : array-like
+            Observation IDs.
+
+        Returns
+        -------
+        mask : `~numpy.ndarray`
+            Boolean row mask.
+        """
+        obs_ids = np.unique(np.asarray(obs_ids, dtype=np.int64))
+        if len(obs_ids) == 0:
+            return np.zeros(len(self), dtype=bool)
+        idx = np.clip(np.searchsorted(obs_ids, self.obs_id), 0, len(obs_ids) - 1)
+        return obs_ids[idx] == self.obs_id
+
+
+def subset_index_tables(indir, outdir, obs_ids):
+    """Write obs and HDU index tables for a subset of observations.
+
+    Each index table is read once. The obs index rows are selected with
+    `ObsIndexCache.select_obs_id` (the cache is built on first use), the
+    HDU index rows with `numpy.isin` on the OBS_IDs present in the obs
+    index, so that the two output tables are consistent.
+
+    Parameters
+    ----------
+    indir, outdir : str or `~pathlib.Path`
+        Folders with ``obs-index.fits.gz`` and ``hdu-index.fits.gz``.
+    obs_ids : array-like
+        Observation IDs to keep.
+
+    Returns
+    -------
+    obs_ids : `~numpy.ndarray`
+        Observation IDs in the subset.
+    """
+    indir, outdir = Path(indir), Path(outdir)
+    outdir.mkdir(exist_ok=True, parents=True)
+    obs_ids = np.unique(np.asarray(obs_ids, dtype=np.int64))
+
+    path = indir / "obs-index.fits.gz"
+    mask = ObsIndexCache.read(path).select_obs_id(obs_ids)
+    table = Table.read(path)[mask]
+    missing = np.setdiff1d(obs_ids, table["OBS_ID"])
+    if len(missing):
+        log.warning(f"OBS_IDs not in obs index: {missing.tolist()}")
+    obs_ids = np.asarray(table["OBS_ID"], dtype=np.int64)
+
+    filename = outdir / "obs-index.fits.gz"
+    print(f"Writing {filename}")
+    table.write(filename, overwrite=True)
+
+    table = Table.read(indir / "hdu-index.fits.gz")
+    table = table[np.isin(table["OBS_ID"], obs_ids)]
+
+    filename = outdir / "hdu-index.fits.gz"
+    print(f"Writing {filename}")
+    table.write(filename, overwrite=True)
+
+    return obs_ids
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(
+        description="Write obs and HDU index tables for a subset of OBS_IDs"
+    )
+    parser.add_argument("indir", help="Folder with the full index tables")
+    parser.add_argument("outdir", help="Output folder")
+    parser.add_argument("--obs-id", type=int, nargs="+", default=[], help="OBS_IDs")
+    parser.add_argument("--obs-id-file", help="Text file with one OBS_ID per line")
+    args = parser.parse_args(args)
+
+    obs_ids = list(args.obs_id)
+    if args.obs_id_file:
+        obs_ids.extend(np.loadtxt(args.obs_id_file, dtype=np.int64, ndmin=1))
+
+    subset_index_tables(args.indir, args.outdir, obs_ids)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,69 @@
-"""Add phase for two obs on Vela pulsar from CTA DC-1"""
+"""Add phase for obs on Vela pulsar from CTA DC-1
+
+By default the first two Vela observations are phased and written with
+the full event list, as distributed in this folder. For a full campaign,
+run in batch mode, e.g.::
+
+    python adding_phase_column.py --all --jobs 16 --output sidecar
+
+which phases all matching observations in parallel and only writes the
+new ``PHASE`` column, either to a sidecar file per observation or as a
+new HDU appended to the event file.
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 import numpy as np
 import astropy.units as u
+from astropy.io import fits
 from astropy.time import Time
 from astropy.coordinates import SkyCoord
-from gammapy.data import DataStore
+from gammapy.data import DataStore, EventList
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from obs_index import ObsIndexCache  # noqa: E402
+
+# Parameters for the Vela pulsar model for the DC1 found in model_galactic_pulsars.xml
+f0_vela = 11.19 * u.Hz
+f1_vela = -1.55e-11 * u.Hz / u.s
+f2_vela = 6.46e-23 * u.Hz / ((u.s) ** 2)
+t0_vela = Time(54686.2, format='mjd', scale='utc')
 
 ###########################################################################
 #######################  Extracting Vela files  ###########################
 ###########################################################################
 
-# Load the data store (contains the information about all the DC1 data)
-# Assumes you have an environment variable CTADATA set pointing to the DC1 folder
-data_store = DataStore.from_dir('$CTADATA/index/gps')
-table = data_store.obs_table
-
-# Defining the offset as the angular separation between the observation position and the target position
-pos_obs = SkyCoord(table['GLON_PNT'], table['GLAT_PNT'], frame='galactic', unit='deg')
-pos_target = SkyCoord.from_name('vela')
-offset = pos_target.separation(pos_obs)
 
-# Defining a mask to select all runs targeting Vela with an offset < 2 deg
-mask = (offset < 2 * u.deg)
+def get_obs_ids(filename, target='vela', offset_max=2 * u.deg):
+    """Get list of observation indices of target (Vela by default).
 
+    The selection uses the pointing index cached next to the obs index
+    file ``filename``, see `ObsIndexCache`.
+    """
+    index = ObsIndexCache.read(filename)
+    pos_target = SkyCoord.from_name(target)
 
-# Applying the mask
-table = table[mask]
-
-# Getting the list of observation indices of Vela
-obs_ids = table['OBS_ID']
+    # Defining a mask to select all runs targeting Vela with an offset < 2 deg
+    mask = index.select_cone(pos_target, offset_max)
 
-# Here we just keep the first two observations
-obs_ids = obs_ids[:2]
+    return index.obs_id[mask]
 
 ###########################################################################
 ########################  Phasing the times  ##############################
 ###########################################################################
 
 
-def time2phase(t, t0, f0, f1, f2, phi_0=0):
+def time2phase(t, t0, f0, f1, f2, phi_0=0, dtype=np.float64):
     """Convert time to phase following frequency derivatives.
 
+    The Taylor polynomial is evaluated with Horner's scheme in a single
+    pass over plain float arrays, no `~astropy.units.Quantity` is created
+    per term. For long baselines (many 1e9 turns) use ``dtype=np.longdouble``
+    to keep the phase precision.
+
     Parameters:
     -----------
     t : `~astropy.time.core.Time`
@@ -54,28 +78,167 @@ def time2phase(t, t0, f0, f1, f2, phi_0=0):
         derivative of frequency in Hz / s
      f2 : `~astropy.units.Quantity`
         second derivative of frequency in Hz /s /s
+    dtype : `~numpy.dtype`
+        float type used for the computation, float64 by default
+
+    Returns
+    -------
+    phase : `~numpy.ndarray`
+        phase between 0 and 1
     """
-    tt = (t - t0).sec * u.s  # conversion in seconds
-    phi_1 = f0 * tt  # first phasing term
-    phi_2 = 0.5 * f1 * (tt ** 2)  # second phasing term
-    phi_3 = (1. / 6) * f2 * (tt ** 3)  # third phasing term
-    ph = phi_0 + phi_1 + phi_2 + phi_3  # phase not yet bounded between 0 and 1
-    return ph - ph.astype('int')  # explanations here under
+    dt = t - t0
+    # the time difference is stored as two doubles (in days, not arrays for
+    # a scalar time), adding them in the requested precision avoids rounding
+    # to float64
+    tt = (np.asarray(dt.jd1, dtype=dtype) + np.asarray(dt.jd2, dtype=dtype)) * 86400  # in seconds
 
+    f0 = np.asarray(f0.to_value('Hz'), dtype=dtype)
+    f1 = np.asarray(f1.to_value('Hz s-1'), dtype=dtype)
+    f2 = np.asarray(f2.to_value('Hz s-2'), dtype=dtype)
+
+    # phi_0 + f0 * tt + f1 * tt ** 2 / 2 + f2 * tt ** 3 / 6, not yet bounded between 0 and 1
+    ph = phi_0 + tt * (f0 + tt * (f1 / 2 + tt * (f2 / 6)))
+    # only the fractional part of the number of turns is kept
+    return ph - np.floor(ph)
 
-# Parameters for the Vela pulsar model for the DC1 found in model_galactic_pulsars.xml
-f0_vela = 11.19 * u.Hz
-f1_vela = -1.55e-11 * u.Hz / u.s
-f2_vela = 6.46e-23 * u.Hz / ((u.s) ** 2)
-t0_vela = Time(54686.2, format='mjd', scale='utc')
 
-# Loop over all Vela observations
-for obs_id in obs_ids:
-    events = data_store.obs(obs_id).events
-    times = events.time
-    phases = np.fromiter((time2phase(times, t0_vela, f0_vela, f1_vela, f2_vela)), np.float)
-    events.table['PHASE'] = phases
+def read_ephemeris(filename=None):
+    """Read ephemeris from JSON file, Vela DC1 model by default.
 
-    filename = "gps_baseline_{:06d}.fits".format(obs_id)
-    print('Writing {}'.format(filename))
-    events.table.write(filename, overwrite=True)
+    The JSON file has the keys ``t0`` (MJD, UTC), ``f0`` (Hz),
+    ``f1`` (Hz / s) and ``f2`` (Hz / s / s).
+    """
+    if filename is None:
+        return dict(t0=t0_vela, f0=f0_vela, f1=f1_vela, f2=f2_vela)
+
+    with open(filename) as fh:
+        data = json.load(fh)
+
+    return dict(
+        t0=Time(data['t0'], format='mjd', scale='utc'),
+        f0=data['f0'] * u.Hz,
+        f1=data['f1'] * u.Hz / u.s,
+        f2=data['f2'] * u.Hz / ((u.s) ** 2),
+    )
+
+
+def make_phase_hdu(events, ephemeris):
+    """Make HDU with only the ``PHASE`` column (and ``EVENT_ID`` to join)."""
+    columns = []
+    if 'EVENT_ID' in events.table.colnames:
+        columns.append(fits.Column(name='EVENT_ID', format='K', array=events.table['EVENT_ID']))
+    phases = time2phase(events.time, **ephemeris)
+    columns.append(fits.Column(name='PHASE', format='D', array=phases))
+
+    hdu = fits.BinTableHDU.from_columns(columns, name='PHASE')
+    hdu.header['T0_MJD'] = ephemeris['t0'].mjd, 'Ephemeris reference time (MJD, UTC)'
+    hdu.header['F0'] = ephemeris['f0'].to_value('Hz'), 'Frequency (Hz)'
+    hdu.header['F1'] = ephemeris['f1'].to_value('Hz s-1'), 'Frequency derivative (Hz / s)'
+    hdu.header['F2'] = ephemeris['f2'].to_value('Hz s-2'), 'Second derivative (Hz / s / s)'
+    return hdu
+
+
+def add_phase(filename, ephemeris, output='sidecar', outdir='.'):
+    """Phase the events of one event file.
+
+    Parameters
+    ----------
+    filename : str
+        Event list file.
+    ephemeris : dict
+        Ephemeris, see `read_ephemeris`.
+    output : {'sidecar', 'append'}
+        Write the ``PHASE`` HDU to a separate file in ``outdir``,
+        or append it to the event file (fast for uncompressed files,
+        the existing HDUs are not rewritten). An existing ``PHASE`` HDU
+        of the event file is replaced, which rewrites the file.
+
+    Returns
+    -------
+    filename : str
+        File the phases were written to.
+    """
+    events = EventList.read(filename)
+    hdu = make_phase_hdu(events, ephemeris)
+
+    if output == 'append':
+        with fits.open(filename) as hdu_list:
+            exists = 'PHASE' in hdu_list
+        if exists or str(filename).endswith('.gz'):
+            # phased before (replace the PHASE HDU instead of adding a second
+            # one) or gzip compressed (no append mode), the file is rewritten
+            with fits.open(filename, mode='update') as hdu_list:
+                if exists:
+                    hdu_list[hdu_list.index_of('PHASE')] = hdu
+                else:
+                    hdu_list.append(hdu)
+        else:
+            fits.append(filename, hdu.data, hdu.header)
+        return filename
+
+    path = Path(outdir) / (Path(filename).name.split('.')[0] + '_phase.fits')
+    hdu.writeto(path, overwrite=True)
+    return str(path)
+
+
+def add_phase_batch(data_store, obs_ids, ephemeris, output='sidecar', outdir='.', n_jobs=None):
+    """Phase a list of observations in parallel, one process per event file."""
+    filenames = [
+        str(data_store.hdu_table.hdu_location(obs_id=obs_id, hdu_type='events').path())
+        for obs_id in obs_ids
+    ]
+    Path(outdir).mkdir(exist_ok=True, parents=True)
+
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [
+            executor.submit(add_phase, filename, ephemeris, output, outdir)
+            for filename in filenames
+        ]
+        for obs_id, future in zip(obs_ids, futures):
+            print('OBS_ID {}: wrote {}'.format(obs_id, future.result()))
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--datastore', default='$CTADATA/index/gps', help='Data store directory')
+    parser.add_argument('--ephemeris', help='Ephemeris JSON file (default: Vela DC1 model)')
+    parser.add_argument('--obs-id', type=int, nargs='+', help='OBS_IDs (default: select by target)')
+    parser.add_argument('--target', default='vela', help='Target name for the selection')
+    parser.add_argument('--offset-max', type=float, default=2, help='Max target offset (deg)')
+    parser.add_argument('--all', action='store_true', help='Phase all selected observations')
+    parser.add_argument('--output', choices=['sidecar', 'append'], help='Batch mode output')
+    parser.add_argument('--outdir', default='.', help='Output folder for sidecar files')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes')
+    args = parser.parse_args(args)
+
+    # Load the data store (contains the information about all the DC1 data)
+    # Assumes you have an environment variable CTADATA set pointing to the DC1 folder
+    data_store = DataStore.from_dir(args.datastore)
+    ephemeris = read_ephemeris(args.ephemeris)
+
+    if args.obs_id:
+        obs_ids = args.obs_id
+    else:
+        filename = Path(os.path.expandvars(args.datastore)) / 'obs-index.fits.gz'
+        obs_ids = get_obs_ids(filename, args.target, args.offset_max * u.deg)
+        # Here we just keep the first two observations
+        obs_ids = list(obs_ids) if args.all else list(obs_ids[:2])
+
+    if args.output:
+        add_phase_batch(data_store, obs_ids, ephemeris, args.output, args.outdir, args.jobs)
+        return
+
+    # Loop over all Vela observations
+    for obs_id in obs_ids:
+        events = data_store.obs(obs_id).events
+        times = events.time
+        phases = time2phase(times, **ephemeris)
+        events.table['PHASE'] = phases
+
+        filename = "gps_baseline_{:06d}.fits".format(obs_id)
+        print('Writing {}'.format(filename))
+        events.table.write(filename, overwrite=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Benchmark the pulsar phase computation on a large simulated event list.
+
+Compares `time2phase` (float64 and extended precision) with the previous
+implementation, which built `~astropy.units.Quantity` arrays for every term
+and went through ``np.fromiter``.
+
+python benchmark_phase.py --n-events 10000000
+"""
+import argparse
+from time import perf_counter
+import numpy as np
+import astropy.units as u
+from astropy.time import TimeDelta
+from adding_phase_column import time2phase, t0_vela, f0_vela, f1_vela, f2_vela
+
+
+def time2phase_quantity(t, t0, f0, f1, f2, phi_0=0):
+    """Previous implementation, kept for comparison."""
+    tt = (t - t0).sec * u.s
+    ph = phi_0 + f0 * tt + 0.5 * f1 * (tt ** 2) + (1. / 6) * f2 * (tt ** 3)
+    ph = ph.to_value('')
+    return np.fromiter(ph - ph.astype('int'), np.float64)
+
+
+def phase_difference(a, b):
+    """Absolute phase difference, taking the wrap at 1 into account."""
+    d = np.abs(a - b)
+    return np.minimum(d, 1 - d)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--n-events', type=int, default=10_000_000)
+    parser.add_argument('--baseline', type=float, default=15, help='Baseline in years')
+    args = parser.parse_args(args)
+
+    rng = np.random.default_rng(0)
+    seconds = np.sort(rng.uniform(0, args.baseline * 365.25 * 86400, args.n_events))
+    times = t0_vela + TimeDelta(seconds, format='sec')
+
+    results = {}
+    for name, func in [
+        ('quantity', lambda: time2phase_quantity(times, t0_vela, f0_vela, f1_vela, f2_vela)),
+        ('float64', lambda: time2phase(times, t0_vela, f0_vela, f1_vela, f2_vela)),
+        ('longdouble', lambda: time2phase(times, t0_vela, f0_vela, f1_vela, f2_vela, dtype=np.longdouble)),
+    ]:
+        t_start = perf_counter()
+        results[name] = func()
+        print('{:12s}: {:8.3f} s'.format(name, perf_counter() - t_start))
+
+    reference = results['longdouble']
+    for name in ['quantity', 'float64']:
+        diff = phase_difference(results[name], reference).max()
+        print('max |phase - phase(longdouble)| for {:8s}: {:.2e}'.format(name, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,21 @@
+"""Tests of the pulsar phase computation.
+
+python -m pytest test_adding_phase_column.py
+"""
+import numpy as np
+from numpy.testing import assert_allclose
+import pytest
+from astropy.time import TimeDelta
+from adding_phase_column import time2phase, t0_vela, f0_vela, f1_vela, f2_vela
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.longdouble])
+def test_time2phase_scalar(dtype):
+    seconds = np.array([0, 1e3, 1e8])
+    times = t0_vela + TimeDelta(seconds, format='sec')
+    phases = time2phase(times, t0_vela, f0_vela, f1_vela, f2_vela, dtype=dtype)
+
+    for time, phase in zip(times, phases):
+        result = time2phase(time, t0_vela, f0_vela, f1_vela, f2_vela, dtype=dtype)
+        assert np.ndim(result) == 0
+        assert_allclose(result, phase)
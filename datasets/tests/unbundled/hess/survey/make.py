@@ -3,6 +3,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import logging
 
 import os
+import sys
 from pathlib import Path
 
 import astropy.units as u
@@ -11,6 +12,9 @@ from astropy.nddata import Cutout2D
 from astropy.coordinates import SkyCoord
 from astropy.wcs import WCS
 
+sys.path.insert(0, str(Path(__file__).resolve().parents[4]))
+import fits_output  # noqa: E402
+
 log = logging.getLogger(__name__)
 
 KEEP = ['Significance', 'SignificanceExtended', 'On', 'Off',
@@ -54,7 +58,8 @@ for hdu in hdu_list:
     cutout_hdu = fits.ImageHDU(data=cutout.data, header=header, name=hdu.name)
     hdu_list_cutout.append(cutout_hdu)
 
-output_filename = 'hess_survey_snippet.fits.gz'
+# Output format is set by the FITS_COMPRESSION environment variable
+output_filename = fits_output.get_filename('hess_survey_snippet')
 log.info('Writing {}'.format(output_filename))
-hdu_list_cutout.writeto(output_filename, clobber=True)
+fits_output.write(hdu_list_cutout, 'hess_survey_snippet')
 
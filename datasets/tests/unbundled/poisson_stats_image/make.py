@@ -1,8 +1,28 @@
 # Licensed under a 3-clause BSD style license - see LICENSE.rst
 """Simulate test dataset.
+
+The output file format is selected with the ``FITS_COMPRESSION``
+environment variable, see ``datasets/fits_output.py``.
+
+By default the 200 x 200 test dataset in this folder and its TS images
+are made. Large synthetic inputs for benchmarks (e.g. TS images and
+fitting) are made with ``--synthetic``, e.g.::
+
+    python make.py --synthetic --shape 10000 10000 --n-sources 500 --output input_large
+
+which writes one file with the same images as ``input_all`` (plus the
+``source`` image), streamed to disk in blocks of rows, and the matching
+PSF to ``input_large_psf.json``. With ``--ts`` the TS images of the
+synthetic dataset are computed as well (``input_large_ts_<scale>``).
 """
 from __future__ import print_function, division
+import argparse
+import gzip
 import json
+import shutil
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 import numpy as np
 from astropy import units as u
 from astropy.io import fits
@@ -13,17 +33,26 @@ from regions import CircleSkyRegion
 
 from gammapy.utils.random import get_random_state
 from gammapy.image import SkyImageList, SkyImage
-from gammapy.scripts.image_ts import image_ts_main
+from gammapy.detect import compute_ts_image_multiscale
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[3]))
+import fits_output  # noqa: E402
+
+
+def write_image(data, header, name):
+    hdu = fits.PrimaryHDU(data=data, header=header)
+    filename = fits_output.get_filename(name)
+    print('Writing {}'.format(filename))
+    fits_output.write(fits.HDUList([hdu]), name)
 
 
-def make_psf(psf_sigma):
+def make_psf(psf_sigma, filename='psf.json'):
     psf_fwhm = psf_sigma * 2 * np.sqrt(2 * np.log(2))
     psf = {}
     psf['psf1'] = {'ampl': 1, 'fwhm': psf_fwhm}
     psf['psf2'] = {'ampl': 0, 'fwhm': 1E-5}
     psf['psf3'] = {'ampl': 0, 'fwhm': 1E-5}
 
-    filename = 'psf.json'
     print('Writing {}'.format(filename))
     with open(filename, 'w') as f:
         json.dump(psf, f, indent=4)
@@ -65,45 +94,29 @@ def make_images(psf_sigma):
     header = wcs.to_header()
 
     mask = ~exclusion.data
-    hdu = fits.PrimaryHDU(data=mask.astype('int32'), header=header)
-    filename = 'exclusion.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
-
-    hdu = fits.PrimaryHDU(data=data.astype('int32'), header=header)
-    filename = 'counts.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
+    write_image(mask.astype('int32'), header, 'exclusion')
+    write_image(data.astype('int32'), header, 'counts')
+    write_image(model(x, y).astype('float32'), header, 'model')
+    write_image(background(x, y).astype('float32'), header, 'background')
+    write_image(source(x, y).astype('float32'), header, 'source')
 
-    hdu = fits.PrimaryHDU(data=model(x, y).astype('float32'), header=header)
-    filename = 'model.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
-
-    hdu = fits.PrimaryHDU(data=background(x, y).astype('float32'), header=header)
-    filename = 'background.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
+    exposure = 1E12 * np.ones(shape)
+    write_image(exposure.astype('float32'), header, 'exposure')
 
-    hdu = fits.PrimaryHDU(data=source(x, y).astype('float32'), header=header)
-    filename = 'source.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
 
-    exposure = 1E12 * np.ones(shape)
-    hdu = fits.PrimaryHDU(data=exposure.astype('float32'), header=header)
-    filename = 'exposure.fits.gz'
-    print('Writing {}'.format(filename))
-    hdu.writeto(filename, clobber=True)
+def read_image(name):
+    # SkyImage.read takes HDU 0, which is empty for tile compressed files
+    hdu = fits_output.read_image_hdus(fits_output.get_filename(name))[0]
+    return SkyImage.from_image_hdu(hdu)
 
 
 def make_images_grouped():
     images = SkyImageList([
-        SkyImage.read('counts.fits.gz'),
-        SkyImage.read('background.fits.gz'),
-        SkyImage.read('exposure.fits.gz'),
-        SkyImage.read('exclusion.fits.gz'),
-        SkyImage.read('model.fits.gz'),
+        read_image('counts'),
+        read_image('background'),
+        read_image('exposure'),
+        read_image('exclusion'),
+        read_image('model'),
     ])
     images[0].name = 'counts'
     images[1].name = 'background'
@@ -111,33 +124,191 @@ def make_images_grouped():
     images[3].name = 'exclusion'
     images[4].name = 'model'
 
-    filename = 'input_all.fits.gz'
+    filename = fits_output.get_filename('input_all')
     print('Writing {}'.format(filename))
-    images.write(filename, clobber=True)
+    fits_output.write(images.to_hdu_list(), 'input_all')
 
 
-def make_ts_image(scale):
-    filename = 'expected_ts_{}.fits.gz'.format(scale)
-    args = ['input_all.fits.gz', filename, "--psf", 'psf.json', "--scales", scale, '--overwrite']
-    print('Executing command: gammapy-image-ts {}'.format(' '.join(args)))
-    print('Writing {}'.format(filename))
-    image_ts_main(args)
+_TS_INPUTS = None
 
 
-def make_ts_image(scale):
-    filename = 'expected_ts_{}.fits.gz'.format(scale)
-    args = ['input_all.fits.gz', filename, "--psf", 'psf.json', "--scales", scale, '--overwrite']
-    print('Executing command: gammapy-image-ts {}'.format(' '.join(args)))
-    print('Writing {}'.format(filename))
-    image_ts_main(args)
+def _init_ts_worker(images, psf_parameters):
+    """Keep the inputs in each worker process, instead of sending them per scale."""
+    global _TS_INPUTS
+    _TS_INPUTS = images, psf_parameters
 
-if __name__ == '__main__':
-    psf_sigma = 3
 
-    make_psf(psf_sigma)
-    make_images(psf_sigma)
-    make_images_grouped()
+def _compute_ts_image(scale):
+    images, psf_parameters = _TS_INPUTS
+    # the scales already run in parallel, no nested process pool per scale
+    return compute_ts_image_multiscale(images, psf_parameters, [scale], parallel=False)[0]
+
+
+def make_ts_images(scales, n_jobs=None, stem='input_all', psf_filename='psf.json',
+                   output='expected_ts'):
+    """Compute TS images for all scales, same as ``gammapy-image-ts``.
+
+    The input images (file ``stem``) and PSF are read once and the scales
+    are computed concurrently in a process pool, one output file
+    ``<output>_<scale>`` per scale.
+    """
+    images = SkyImageList.from_hdu_list(fits_output.read_image_hdus(fits_output.get_filename(stem)))
+    with open(psf_filename) as fh:
+        psf_parameters = json.load(fh)
+
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_ts_worker,
+                             initargs=(images, psf_parameters)) as executor:
+        results = executor.map(_compute_ts_image, [float(_) for _ in scales])
+        for scale, result in zip(scales, results):
+            name = '{}_{}'.format(output, scale)
+            print('Writing {}'.format(fits_output.get_filename(name)))
+            fits_output.write(result.to_hdu_list(), name)
+
+
+def _image_header(header, shape, dtype, name, primary):
+    """FITS header for an image HDU of given shape and dtype."""
+    cls = fits.PrimaryHDU if primary else fits.ImageHDU
+    header = cls(data=np.zeros((1, 1), dtype=dtype), header=header.copy()).header
+    header['NAXIS1'], header['NAXIS2'] = shape[1], shape[0]
+    header['EXTNAME'] = name
+    return header
+
+
+def _gaussians(sources, y, x):
+    """Sum of Gaussian sources on the grid of rows ``y`` and columns ``x``.
+
+    The Gaussians are separable, so each source is an outer product of a
+    row and a column profile, evaluated within 5 sigma of its center.
+    """
+    data = np.zeros((len(y), len(x)))
+    for x_0, y_0, sigma, amplitude in sources:
+        radius = 5 * sigma
+        if y_0 + radius < y[0] or y_0 - radius > y[-1]:
+            continue
+        imin, imax = np.searchsorted(x, [x_0 - radius, x_0 + radius])
+        profile_y = amplitude * np.exp(-0.5 * ((y - y_0) / sigma) ** 2)
+        profile_x = np.exp(-0.5 * ((x[imin:imax] - x_0) / sigma) ** 2)
+        data[:, imin:imax] += np.outer(profile_y, profile_x)
+    return data
+
+
+def _exclusion(sources, y, x, radius):
+    """Exclusion mask (0 within ``radius`` pixels of any source) on a grid."""
+    data = np.ones((len(y), len(x)), dtype='int32')
+    for x_0, y_0, _, _ in sources:
+        if y_0 + radius < y[0] or y_0 - radius > y[-1]:
+            continue
+        imin, imax = np.searchsorted(x, [x_0 - radius, x_0 + radius])
+        distance2 = (y[:, np.newaxis] - y_0) ** 2 + (x[np.newaxis, imin:imax] - x_0) ** 2
+        data[:, imin:imax][distance2 < radius ** 2] = 0
+    return data
+
+
+def make_images_synthetic(stem, shape=(2000, 2000), n_sources=10, psf_sigma=3, seed=0,
+                          block_rows=256, binsz=0.02, exclusion_radius=0.5):
+    """Simulate a large test dataset in one file, like ``input_all``.
+
+    Gaussian sources (sigma 1 to 8 pixels, convolved with a Gaussian PSF
+    of ``psf_sigma`` pixels, 100 to 1000 counts) at random positions on a
+    flat background of 1 count per pixel. The images (counts, background,
+    exposure, exclusion, model, source) are computed and written in blocks
+    of ``block_rows`` rows with `~astropy.io.fits.StreamingHDU`, so the
+    memory use doesn't depend on the image size.
+
+    Tile compression needs the full images, so for ``FITS_COMPRESSION=tile``
+    an uncompressed file is written.
+    """
+    ny, nx = shape
+    random_state = get_random_state(seed)
+    source_sigma = random_state.uniform(1, 8, n_sources)
+    sigma = np.sqrt(psf_sigma ** 2 + source_sigma ** 2)
+    norm = random_state.uniform(1E2, 1E3, n_sources)
+    sources = np.column_stack([
+        random_state.uniform(0, nx - 1, n_sources),
+        random_state.uniform(0, ny - 1, n_sources),
+        sigma,
+        norm / (2 * np.pi * sigma ** 2),
+    ])
+
+    wcs = WCS(naxis=2)
+    wcs.wcs.crpix = [nx / 2 + 0.5, ny / 2 + 0.5]
+    wcs.wcs.cdelt = np.array([binsz, binsz])
+    wcs.wcs.crval = [0, 0]
+    wcs.wcs.ctype = ['GLON-CAR', 'GLAT-CAR']
+    header = wcs.to_header()
+
+    # coordinate grid, reused for all blocks
+    x = np.arange(nx, dtype=float)
+
+    def model(y):
+        return _gaussians(sources, y, x) + 1
+
+    images = [
+        ('counts', 'int32', lambda y: random_state.poisson(model(y))),
+        ('background', 'float32', lambda y: np.ones((len(y), nx))),
+        ('exposure', 'float32', lambda y: 1E12 * np.ones((len(y), nx))),
+        ('exclusion', 'int32', lambda y: _exclusion(sources, y, x, exclusion_radius / binsz)),
+        ('model', 'float32', model),
+        ('source', 'float32', lambda y: _gaussians(sources, y, x)),
+    ]
+
+    path = Path(fits_output.get_filename(stem, 'none'))
+    path_tmp = path.parent / '.{}'.format(path.name)
+    if path_tmp.exists():
+        path_tmp.unlink()
+
+    for idx, (name, dtype, func) in enumerate(images):
+        hdu = fits.StreamingHDU(str(path_tmp), _image_header(header, shape, dtype, name, idx == 0))
+        for ymin in range(0, ny, block_rows):
+            y = np.arange(ymin, min(ymin + block_rows, ny), dtype=float)
+            hdu.write(func(y).astype(dtype))
+        hdu.close()
+
+    if fits_output.COMPRESSION == 'gzip':
+        path = Path(fits_output.get_filename(stem, 'gzip'))
+        path_gz = path.parent / '.{}'.format(path.name)
+        with path_tmp.open('rb') as fh_in, gzip.GzipFile(str(path_gz), 'wb', mtime=0,
+                                                         compresslevel=fits_output.GZIP_LEVEL) as fh_out:
+            shutil.copyfileobj(fh_in, fh_out)
+        path_tmp.unlink()
+        path_tmp = path_gz
+
+    print('Writing {}'.format(path))
+    path_tmp.replace(path)
+    return path
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--psf-sigma', type=float, default=3, help='PSF sigma (pixels)')
+    parser.add_argument('--jobs', type=int, help='Number of worker processes for the TS images')
+    parser.add_argument('--synthetic', action='store_true', help='Make a large synthetic dataset')
+    parser.add_argument('--shape', type=int, nargs=2, default=[2000, 2000], metavar=('NY', 'NX'))
+    parser.add_argument('--n-sources', type=int, default=10, help='Number of sources')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+    parser.add_argument('--block-rows', type=int, default=256, help='Rows computed and written at once')
+    parser.add_argument('--binsz', type=float, default=0.02, help='Pixel size (deg)')
+    parser.add_argument('--output', default='input_synthetic', help='Output file stem')
+    parser.add_argument('--ts', action='store_true', help='Make the TS images of the synthetic dataset')
+    args = parser.parse_args(args)
 
     scales = ['0.000', '0.050', '0.100', '0.200']
-    for scale in scales:
-        make_ts_image(scale)
+
+    if args.synthetic:
+        psf_filename = '{}_psf.json'.format(args.output)
+        make_psf(args.psf_sigma, psf_filename)
+        make_images_synthetic(args.output, tuple(args.shape), args.n_sources, args.psf_sigma,
+                              args.seed, args.block_rows, args.binsz)
+        if args.ts:
+            make_ts_images(scales, args.jobs, args.output, psf_filename,
+                           '{}_ts'.format(args.output))
+        return
+
+    make_psf(args.psf_sigma)
+    make_images(args.psf_sigma)
+    make_images_grouped()
+    make_ts_images(scales, args.jobs)
+
+
+if __name__ == '__main__':
+    main()
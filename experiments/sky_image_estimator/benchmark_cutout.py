@@ -0,0 +1,56 @@
+"""Benchmark the per observation cutouts of `IACTSkyImageEstimator`.
+
+The Crab observations are estimated on a large Galactic plane reference
+image, once on cutouts around the pointings and once on the full reference
+image, and the speedup is reported together with the largest difference
+of the result images.
+
+python benchmark_cutout.py --width 60 --height 16 --binsz 0.02
+"""
+import argparse
+from time import perf_counter
+import numpy as np
+from astropy import units as u
+from gammapy.data import DataStore
+from gammapy.background import RingBackgroundEstimator
+from gammapy.image import SkyImage, SkyMask
+from sky_image_estimator import IACTSkyImageEstimator
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--datastore', default='$GAMMAPY_EXTRA/datasets/hess-crab4-hd-hap-prod2/')
+    parser.add_argument('--obs-id', type=int, nargs='+', default=[23523, 23526, 23559, 23592])
+    parser.add_argument('--width', type=float, default=60, help='Longitude range (deg)')
+    parser.add_argument('--height', type=float, default=16, help='Latitude range (deg)')
+    parser.add_argument('--binsz', type=float, default=0.02, help='Pixel size (deg)')
+    args = parser.parse_args(args)
+
+    data_store = DataStore.from_dir(args.datastore)
+    observations = data_store.obs_list(args.obs_id)
+
+    # Galactic plane image, centered in longitude on the Crab
+    reference = SkyImage.empty(nxpix=int(args.width / args.binsz), nypix=int(args.height / args.binsz),
+                               binsz=args.binsz, xref=184.56, yref=0, coordsys='GAL', proj='CAR')
+    exclusion_mask = SkyMask.empty_like(reference, fill=1)
+    background_estimator = RingBackgroundEstimator(r_in=0.3 * u.deg, width=0.2 * u.deg)
+    print('Reference image: {} pixels'.format(reference.data.shape))
+
+    images, times = {}, {}
+    for name, cutout in [('cutout', True), ('full', False)]:
+        estimator = IACTSkyImageEstimator(reference=reference, emin=1 * u.TeV, emax=10 * u.TeV,
+                                          background_estimator=background_estimator,
+                                          exclusion_mask=exclusion_mask, cutout=cutout)
+        t_start = perf_counter()
+        images[name] = estimator.run(observations)
+        times[name] = perf_counter() - t_start
+        print('{:8s}: {:8.3f} s'.format(name, times[name]))
+
+    print('speedup : {:8.1f}'.format(times['full'] / times['cutout']))
+    for name in ['counts', 'exposure', 'background']:
+        diff = np.abs(images['cutout'][name].data - images['full'][name].data).max()
+        print('max |cutout - full| for {:10s}: {:.2e}'.format(name, diff))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,18 +1,172 @@
+import hashlib
 from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
+from scipy.fftpack import next_fast_len
 
 from astropy import units as u
-from astropy.coordinates import Angle
+from astropy.io import fits
+from astropy.coordinates import Angle, SkyCoord
+from astropy.wcs.utils import proj_plane_pixel_scales
 
 from gammapy.image import SkyImage, SkyImageList
-from gammapy.cube import exposure_cube as compute_exposure_cube
+from gammapy.background import RingBackgroundEstimator, AdaptiveRingBackgroundEstimator
 from gammapy.cube import SkyCube
+from gammapy.irf import TablePSF
 from gammapy.spectrum.models import PowerLaw2
 from gammapy.utils.energy import EnergyBounds, Energy
 from gammapy.spectrum import LogEnergyAxis
 
 SPECTRAL_INDEX = 2.3
+# offset grid step for the effective area profile, see `_exposure_profile`
+OFFSET_STEP = Angle(0.005, 'deg')
+# coarse offset grid step and containment for the PSF kernels, see `_psf_kernel`
+PSF_OFFSET_STEP = Angle(0.25, 'deg')
+PSF_CONTAINMENT = 0.99
+
+
+def _unit_vectors(coordinates):
+    """
+    Cartesian unit vectors (3, ...) for sky coordinates.
+    """
+    icrs = coordinates.icrs
+    lon, lat = icrs.ra.rad, icrs.dec.rad
+    return np.array([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+
+def _circle(center, radius, n_points=64):
+    """
+    Points on a circle of given radius around a sky position (ICRS).
+    """
+    vector = _unit_vectors(center)
+    axis = [0, 0, 1] if abs(vector[2]) < 0.9 else [1, 0, 0]
+    e1 = np.cross(vector, axis)
+    e1 /= np.sqrt(np.sum(e1 ** 2))
+    e2 = np.cross(vector, e1)
+
+    phi = np.linspace(0, 2 * np.pi, n_points, endpoint=False)
+    r = Angle(radius).rad
+    points = (np.cos(r) * vector[:, np.newaxis] +
+              np.sin(r) * (np.cos(phi) * e1[:, np.newaxis] + np.sin(phi) * e2[:, np.newaxis]))
+    lon = np.arctan2(points[1], points[0])
+    lat = np.arcsin(np.clip(points[2], -1, 1))
+    return SkyCoord(lon, lat, unit='rad', frame='icrs')
+
+
+def _aeff_key(aeff):
+    """
+    Identity of an effective area table, from its data and axes.
+    """
+    sha = hashlib.sha1()
+    for array in [aeff.data, aeff.energy.data, aeff.offset.data]:
+        sha.update(np.ascontiguousarray(getattr(array, 'value', array)).tobytes())
+    return sha.hexdigest()
+
+
+def _psf_key(psf):
+    """
+    Identity of a PSF table, from the arrays of its attributes.
+    """
+    sha = hashlib.sha1(type(psf).__name__.encode())
+    for name, value in sorted(vars(psf).items()):
+        for array in value if isinstance(value, (list, tuple)) else [value]:
+            array = getattr(array, 'value', array)
+            if isinstance(array, (np.ndarray, np.number, float, int)):
+                sha.update(name.encode())
+                sha.update(np.ascontiguousarray(array).tobytes())
+    return sha.hexdigest()
+
+
+def _add_kernels(kernel_1, kernel_2):
+    """
+    Sum of two odd sized kernels, centered on each other.
+    """
+    shape = np.maximum(kernel_1.shape, kernel_2.shape)
+    result = np.zeros(shape)
+    for kernel in [kernel_1, kernel_2]:
+        dy, dx = [(n - m) // 2 for n, m in zip(shape, kernel.shape)]
+        result[dy:shape[0] - dy, dx:shape[1] - dx] += kernel
+    return result
+
+
+def _add_patches(patch_1, patch_2):
+    """
+    Sum of two image patches, on the union of their bounding boxes.
+
+    A patch is a tuple of bounding box ``(ymin, ymax, xmin, xmax)`` in
+    pixels of the reference image, a dict of images cut to it and a dict
+    of kernel images (not tied to a position, see `_add_kernels`).
+    """
+    bboxes = [patch_1[0], patch_2[0]]
+    ymin, xmin = [min(_[idx] for _ in bboxes) for idx in [0, 2]]
+    ymax, xmax = [max(_[idx] for _ in bboxes) for idx in [1, 3]]
+
+    images, kernels = OrderedDict(), OrderedDict()
+    for (y0, y1, x0, x1), patch_images, patch_kernels in [patch_1, patch_2]:
+        for name, data in patch_images.items():
+            if name not in images:
+                images[name] = np.zeros((ymax - ymin, xmax - xmin))
+            images[name][y0 - ymin:y1 - ymin, x0 - xmin:x1 - xmin] += data
+        for name, data in patch_kernels.items():
+            kernels[name] = _add_kernels(kernels[name], data) if name in kernels else data
+    return (ymin, ymax, xmin, xmax), images, kernels
+
+
+def _tree_sum(patches):
+    """
+    Pairwise (tree) sum of a stream of image patches.
+
+    Patches are merged like the digits of a binary counter, so that only
+    one partial sum per tree level is kept in memory.
+    """
+    stack = []
+    for patch in patches:
+        if patch is None:
+            continue
+        level = 0
+        while stack and stack[-1][0] == level:
+            patch = _add_patches(stack.pop()[1], patch)
+            level += 1
+        stack.append((level, patch))
+
+    if not stack:
+        return None
+
+    patch = stack.pop()[1]
+    while stack:
+        patch = _add_patches(stack.pop()[1], patch)
+    return patch
+
+
+_WORKER_ESTIMATOR = None
+
+
+def _init_worker(estimator):
+    """
+    Keep one estimator per worker process, instead of sending it with every task.
+    """
+    global _WORKER_ESTIMATOR
+    _WORKER_ESTIMATOR = estimator
+
+
+def _run_batch(observations):
+    return _WORKER_ESTIMATOR._run_batch(observations)
+
+
+def _batches(observations, batch_size):
+    """
+    Split observations into lists of ``batch_size``.
+    """
+    batch = []
+    for observation in observations:
+        batch.append(observation)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
 
 class IACTSkyImageEstimator(object):
     """
@@ -23,6 +177,7 @@ class IACTSkyImageEstimator(object):
         * counts
         * exposure
         * background
+        * psf (optional, exposure weighted mean PSF kernel)
     
     Parameters
     ----------
@@ -36,123 +191,662 @@ class IACTSkyImageEstimator(object):
         Upper bound of offset range.
     spectral_model : `~gammapy.spectrum.models.SpectralModel`
         Spectral model assumption to compute mean exposure and psf image.
+        By default a power law normalised in each energy band.
     exclusion_mask : `~gammapy.image.SkyMask`
         Exclusion mask.
     background_estimator : 
         Background estimation method. 
+    exposure_cache_size : int
+        Number of exposure images (per unit livetime) kept in a cache keyed by
+        effective area and pointing, zero to disable.
+    cutout : bool
+        Compute the images of each observation on a cutout of the reference
+        image around the pointing, see `_run_batch`.
+    compute_psf : bool
+        Compute the exposure weighted mean PSF image, see `_psf_image`.
+    psf_cache_size : int
+        Number of PSF kernels kept in a cache keyed by PSF and effective area,
+        offset and energy band, zero to disable, see `_psf_kernel`.
+    events_chunk_size : int
+        Read the event columns from disk in chunks of this many rows, instead
+        of loading the event lists, see `_event_chunks`.
+    energy_bands : list of tuple
+        Energy bands ``(emin, emax)`` computed in one pass over the
+        observations, instead of the single band ``(emin, emax)``.
     
     """
     def __init__(self, reference, emin, emax, offset_max=Angle(2.5, 'deg'), spectral_model=None,
-                 background_estimator=None, exclusion_mask=None):
+                 background_estimator=None, exclusion_mask=None, exposure_cache_size=0,
+                 cutout=True, compute_psf=False, psf_cache_size=256, events_chunk_size=None,
+                 energy_bands=None):
         self.reference = reference
         self.background_estimator = background_estimator
         self.exclusion_mask = exclusion_mask
+        self.exposure_cache_size = exposure_cache_size
+        self.cutout = cutout
+        self.compute_psf = compute_psf
+        self.psf_cache_size = psf_cache_size
+        self.events_chunk_size = events_chunk_size
+        self._ref_cube = None
+        self._pixel_vectors = None
+        self._exposure_profiles = {}
+        self._exposure_cache = OrderedDict()
+        self._psf_kernels = OrderedDict()
+        self._kernels_fft_cache = {}
         
+        if energy_bands is None:
+            energy_bands = [(emin, emax)]
+        self.energy_bands = list(energy_bands)
+
         if spectral_model is None:
             index = SPECTRAL_INDEX
             amplitude = u.Quantity(1, '')
-            spectral_model = PowerLaw2(index=index, amplitude=amplitude,
-                                       emin=emin, emax=emax)
+            self.spectral_models = [PowerLaw2(index=index, amplitude=amplitude, emin=_emin, emax=_emax)
+                                    for _emin, _emax in self.energy_bands]
+        else:
+            self.spectral_models = [spectral_model] * len(self.energy_bands)
 
-        self.spectral_model = spectral_model
+        emin = min(u.Quantity(_[0], 'TeV') for _ in self.energy_bands)
+        emax = max(u.Quantity(_[1], 'TeV') for _ in self.energy_bands)
         self.parameters = OrderedDict(emin=emin, emax=emax, offset_max=offset_max)
         
-    def _get_empty_skyimage(self):
+    def _get_empty_skyimage(self, bbox=None, band=0):
         """
-        Get empty sky image like reference image.
+        Get empty sky image like reference image, or like a cutout of it.
         """
-        p = self.parameters
-        image = SkyImage.empty_like(self.reference)
-        image.meta['emin'] = str(p['emin'])
-        image.meta['emax'] = str(p['emax'])
+        emin, emax = self.energy_bands[band]
+        reference = self.reference if bbox is None else self._cutout(self.reference, bbox)
+        image = SkyImage.empty_like(reference)
+        image.meta['emin'] = str(emin)
+        image.meta['emax'] = str(emax)
         return image
 
+    @staticmethod
+    def _cutout(image, bbox):
+        """
+        Cutout ``(ymin, ymax, xmin, xmax)`` of an image, with its WCS.
+
+        The data of the cutout is a view of the image data.
+        """
+        ymin, ymax, xmin, xmax = bbox
+        slices = (slice(ymin, ymax), slice(xmin, xmax))
+        return image.__class__(name=image.name, data=image.data[slices],
+                               wcs=image.wcs.slice(slices), unit=image.unit)
+
+    def _cutout_margin(self):
+        """
+        Margin around the offset circle needed by the background estimator.
+
+        The ring kernels reach ``r_in + width`` (``r_out_max + width`` for
+        the adaptive ring), for other estimators ``offset_max`` is used.
+        """
+        p = getattr(self.background_estimator, 'parameters', {})
+        if 'width' in p:
+            return Angle(p.get('r_out_max', p.get('r_in')) + p['width'])
+        return self.parameters['offset_max']
+
+    def _bounding_box(self, pointing, margin=Angle(0, 'deg')):
+        """
+        Bounding box ``(ymin, ymax, xmin, xmax)`` of the reference image pixels
+        within ``offset_max`` of the pointing, extended by ``margin`` and
+        clipped to the image, `None` if there are no pixels within ``offset_max``.
+
+        A box containing the projected offset circle is refined with the
+        pixel offsets inside it. If the circle can't be projected (e.g. more
+        than 90 deg from the center of a TAN projection), the pixel offsets
+        of the full reference image are used instead.
+        """
+        offset_max = self.parameters['offset_max']
+        ny, nx = self.reference.data.shape
+
+        points = _circle(pointing, offset_max)
+        x, y = self.reference.wcs_skycoord_to_pixel(points)
+        x0, y0 = self.reference.wcs_skycoord_to_pixel(pointing)
+        x, y = np.append(x, x0), np.append(y, y0)
+        if np.isfinite(x).all() and np.isfinite(y).all():
+            ymin, ymax = [int(np.clip(_, 0, ny)) for _ in [np.floor(y.min()), np.ceil(y.max()) + 2]]
+            xmin, xmax = [int(np.clip(_, 0, nx)) for _ in [np.floor(x.min()), np.ceil(x.max()) + 2]]
+        else:
+            ymin, ymax, xmin, xmax = 0, ny, 0, nx
+        if ymin == ymax or xmin == xmax:
+            return None
+
+        mask = self._offset_image(pointing, (ymin, ymax, xmin, xmax)) < offset_max
+        rows, cols = np.flatnonzero(mask.any(axis=1)), np.flatnonzero(mask.any(axis=0))
+        if len(rows) == 0:
+            return None
+
+        # CDELT is ignored by WCS with a CD matrix and doesn't include PC
+        scale = proj_plane_pixel_scales(self.reference.wcs).min()
+        pad = int(np.ceil(Angle(margin).deg / scale))
+        return (max(ymin + rows[0] - pad, 0), min(ymin + rows[-1] + 1 + pad, ny),
+                max(xmin + cols[0] - pad, 0), min(xmin + cols[-1] + 1 + pad, nx))
+
     def _get_ref_cube(self, enumbins=11):
-        p = self.parameters
-        
+        """
+        Reference cube on the union of ``enumbins`` log spaced energies per band.
+        """
+        energies = [Energy.equal_log_spacing(emin, emax, enumbins, 'TeV').value
+                    for emin, emax in self.energy_bands]
+        # shared band edges only once
+        energy = Energy(10 ** np.unique(np.round(np.log10(np.concatenate(energies)), 9)), 'TeV')
+
         wcs = self.reference.wcs.deepcopy()
-        shape = (enumbins,) + self.reference.data.shape
+        shape = (len(energy),) + self.reference.data.shape
         data = np.zeros(shape)
         
-        energy = Energy.equal_log_spacing(p['emin'], p['emax'], enumbins, 'TeV')
         energy_axis = LogEnergyAxis(energy, mode='center')
         return SkyCube(data=data, wcs=wcs, energy_axis=energy_axis)
     
-    def _exposure_image(self, observation):
-        p = self.parameters
-        kwargs = {}
-        kwargs['livetime'] = observation.observation_live_time_duration
-        kwargs['pointing'] = observation.pointing_radec
-        kwargs['aeff2d'] = observation.aeff
-        kwargs['offset_max'] = p['offset_max']
-        kwargs['ref_cube'] = self._get_ref_cube()
-        exposure_cube = compute_exposure_cube(**kwargs)
-        
-        energies = exposure_cube.energies('center')
-        weights = self.spectral_model(energies)
-        
-        exposure_cube.data = exposure_cube.data * weights.reshape(-1, 1, 1)
-        exposure = exposure_cube.sky_image_integral(emin=p['emin'], emax=p['emax'])
-        
-        exposure.name = 'exposure'
-        exposure.data = np.nan_to_num(exposure.data)
-        return exposure
+    @property
+    def ref_cube(self):
+        """
+        Reference cube, created once per estimator.
+        """
+        if self._ref_cube is None:
+            self._ref_cube = self._get_ref_cube()
+        return self._ref_cube
+
+    def _offset_image(self, pointing, bbox=None):
+        """
+        Offset of the reference image pixels (in ``bbox``) from the pointing position.
+
+        The pixel positions are converted to unit vectors, so that the offset
+        is a single dot product per pixel. For the full reference image they
+        are cached, for a cutout only the pixels of the cutout are converted.
+        """
+        if bbox is not None:
+            vectors = _unit_vectors(self._cutout(self.reference, bbox).coordinates())
+        else:
+            if self._pixel_vectors is None:
+                self._pixel_vectors = _unit_vectors(self.reference.coordinates())
+            vectors = self._pixel_vectors
+
+        vector = _unit_vectors(pointing)
+        cos_offset = np.tensordot(vector, vectors, axes=1)
+        return Angle(np.arccos(np.clip(cos_offset, -1, 1)), 'rad')
+
+    def _exposure_profile(self, aeff, aeff_key):
+        """
+        Spectrum weighted effective area integrated over the energy bands,
+        as a function of offset.
+
+        The effective area only depends on offset, so it is evaluated on a
+        fine offset grid instead of for every pixel of the reference cube,
+        once on the union energy grid of all bands, and the energy integration
+        is done on that grid per band. The result is cached per effective
+        area table, identified by ``aeff_key`` (see `_aeff_key`).
+
+        Returns
+        -------
+        offset, profiles : `~numpy.ndarray`
+            Offset grid (deg) and profiles (m2), one per energy band.
+        """
+        if aeff_key not in self._exposure_profiles:
+            p = self.parameters
+            offset_max = p['offset_max'].to('deg').value
+            n_offset = int(np.ceil(offset_max / OFFSET_STEP.deg)) + 1
+            offset = Angle(np.linspace(0, offset_max, n_offset), 'deg')
+
+            energies = self.ref_cube.energies('center')
+            area = aeff.evaluate(offset=offset, energy=energies).reshape(len(energies), -1)
+
+            profiles = []
+            for (emin, emax), spectral_model in zip(self.energy_bands, self.spectral_models):
+                weights = spectral_model(energies)
+                data = area * weights.reshape(-1, 1)
+
+                # integrate with the same method as `SkyCube.sky_image_integral`
+                # on the reference cube, with the offset grid as a 1 x N image
+                cube = SkyCube(data=data.reshape((len(energies), 1, -1)), wcs=self.reference.wcs,
+                               energy_axis=self.ref_cube.energy_axis)
+                integral = cube.sky_image_integral(emin=emin, emax=emax)
+                profiles.append(np.nan_to_num(integral.data.to('m2').value.ravel()))
+            self._exposure_profiles[aeff_key] = offset.deg, np.array(profiles)
+        return self._exposure_profiles[aeff_key]
+
+    def _exposure_image(self, observation, aeff, aeff_key, bbox=None):
+        """
+        Compute exposure images in the energy bands, on the cutout ``bbox``.
+
+        The exposure per unit livetime only depends on the effective area
+        and the pointing, so it is interpolated from `_exposure_profile` and
+        optionally cached. Outside ``offset_max`` the exposure is zero, as
+        no counts are selected there. The effective area ``aeff`` of the
+        observation and its ``aeff_key`` are loaded once per observation by
+        the caller, see `_run_batch`.
+        """
+        pointing = observation.pointing_radec
+        livetime = observation.observation_live_time_duration.to('s').value
+        key = (aeff_key, round(pointing.icrs.ra.deg, 6), round(pointing.icrs.dec.deg, 6),
+               bbox)
+
+        if key in self._exposure_cache:
+            self._exposure_cache.move_to_end(key)
+            data = self._exposure_cache[key]
+        else:
+            offset, profiles = self._exposure_profile(aeff, aeff_key)
+            offset_image = self._offset_image(pointing, bbox)
+            data = np.array([np.interp(offset_image.deg, offset, _) for _ in profiles])
+            data[:, offset_image >= self.parameters['offset_max']] = 0
+            if self.exposure_cache_size > 0:
+                self._exposure_cache[key] = data
+                if len(self._exposure_cache) > self.exposure_cache_size:
+                    self._exposure_cache.popitem(last=False)
+
+        images = []
+        for band, band_data in enumerate(data):
+            exposure = self._get_empty_skyimage(bbox, band)
+            exposure.name = 'exposure'
+            exposure.data = band_data * livetime
+            images.append(exposure)
+        return images
     
-    def _psf_image(self, observation):
-        raise NotImplementedError
+    def _psf_kernel(self, psf, psf_key, aeff, aeff_key, offset_index, band=0):
+        """
+        PSF kernel image at a node of the coarse offset grid.
+
+        The PSF is averaged over the energy band with the spectral model times
+        effective area as weights, on the energy nodes of the PSF table. The
+        kernel is optionally cached by the content of the PSF and effective
+        area tables (``psf_key`` and ``aeff_key``, see `_psf_key` and
+        `_aeff_key`), offset node, energy band and spectral model, so it is
+        reused by observations with the same IRFs.
+        """
+        emin, emax = self.energy_bands[band]
+        spectral_model = self.spectral_models[band]
+        key = (psf_key, aeff_key, str(emin), str(emax), str(spectral_model), offset_index)
+
+        if key in self._psf_kernels:
+            self._psf_kernels.move_to_end(key)
+            kernel = self._psf_kernels[key]
+        else:
+            theta = offset_index * PSF_OFFSET_STEP
+            table_psf = psf.to_table_psf(theta=theta)
+
+            # energy range of each PSF node, cut to the energy band
+            energy = table_psf.energy.to('TeV').value
+            edges = np.sqrt(energy[1:] * energy[:-1])
+            lo = np.clip(np.append(energy[0], edges), emin.to('TeV').value, None)
+            hi = np.clip(np.append(edges, energy[-1]), None, emax.to('TeV').value)
+            width = np.clip(hi - lo, 0, None)
+
+            energy = Energy(energy, 'TeV')
+            area = aeff.evaluate(offset=theta, energy=energy).to('m2').value.ravel()
+            flux = spectral_model(energy).value
+            weights = area * flux * width
+
+            psf_value = np.dot(weights, table_psf.psf_value.to('sr-1').value) / weights.sum()
+            mean_psf = TablePSF(table_psf.offset, u.Quantity(psf_value, 'sr-1'))
+            kernel = mean_psf.kernel(self.reference, containment=PSF_CONTAINMENT)
+            kernel = np.asarray(getattr(kernel, 'value', kernel))
+            if self.psf_cache_size > 0:
+                self._psf_kernels[key] = kernel
+                if len(self._psf_kernels) > self.psf_cache_size:
+                    self._psf_kernels.popitem(last=False)
+        return kernel
+
+    def _psf_image(self, observation, psf, psf_key, aeff, aeff_key, exposure, bbox=None, band=0):
+        """
+        Exposure weighted mean PSF kernel image of an observation.
+
+        The PSF kernels are computed on a coarse offset grid (see
+        `_psf_kernel`) and interpolated linearly in offset, so each kernel
+        enters with its interpolation weights times exposure, summed over
+        the pixels of the exposure image (a cutout ``bbox``). The PSF ``psf``
+        and effective area ``aeff`` of the observation and their keys are
+        loaded once per observation by the caller, see `_run_batch`.
+        """
+        offset = self._offset_image(observation.pointing_radec, bbox).deg / PSF_OFFSET_STEP.deg
+        idx = np.floor(offset).astype(int).ravel()
+        frac = (offset.ravel() - idx)
+        data = exposure.data.ravel()
+
+        weights = np.zeros(idx.max() + 2)
+        weights[:-1] += np.bincount(idx, data * (1 - frac))
+        weights[1:] += np.bincount(idx, data * frac)
+
+        kernel = np.zeros((1, 1))
+        for offset_index in np.flatnonzero(weights):
+            kernel = _add_kernels(kernel, weights[offset_index] *
+                                  self._psf_kernel(psf, psf_key, aeff, aeff_key, offset_index,
+                                                   band))
+
+        psf = SkyImage(name='psf', data=kernel / weights.sum())
+        psf.meta['exposure'] = weights.sum()
+        return psf
     
-    def _counts_image(self, observation):
+    def _event_chunks(self, observation):
+        """
+        Pointing position and ``RA``, ``DEC`` (deg), ``ENERGY`` (TeV) columns
+        of the events of an observation, in chunks.
+
+        By default the columns of ``observation.events`` are used. With
+        ``events_chunk_size`` the events HDU is opened with memmap (for
+        uncompressed files) and only these columns are read, chunk by chunk.
+        """
+        if self.events_chunk_size is None:
+            table = observation.events.table
+            pointing = SkyCoord(table.meta['RA_PNT'], table.meta['DEC_PNT'], unit='deg')
+            energy = table['ENERGY'].quantity.to('TeV').value
+            yield pointing, np.asarray(table['RA']), np.asarray(table['DEC']), energy
+            return
+
+        location = observation.location(hdu_type='events')
+        with fits.open(str(location.path()), memmap=True) as hdu_list:
+            hdu = hdu_list[location.hdu_name]
+            pointing = SkyCoord(hdu.header['RA_PNT'], hdu.header['DEC_PNT'], unit='deg')
+            scale = u.Unit(hdu.columns['ENERGY'].unit or 'TeV').to('TeV')
+            for start in range(0, len(hdu.data), self.events_chunk_size):
+                rows = hdu.data[start:start + self.events_chunk_size]
+                yield pointing, rows['RA'], rows['DEC'], rows['ENERGY'] * scale
+
+    def _counts_image(self, observation, bbox=None):
         """
-        Compute counts image in energy band
+        Compute counts images in the energy bands, on the cutout ``bbox``
+
+        Events in any of the bands and within ``offset_max`` of the pointing
+        are selected with one mask per chunk (see `_event_chunks`) and binned
+        with `numpy.bincount` on the flat pixel index per band, no
+        intermediate event lists are created.
         """
         p = self.parameters
-        events = observation.events.select_energy((p['emin'], p['emax']))
-        
+        bands = [[_.to('TeV').value for _ in band] for band in self.energy_bands]
+        cos_offset_max = np.cos(p['offset_max'].rad)
+
+        wcs_image = self._get_empty_skyimage(bbox)
+        ny, nx = wcs_image.data.shape
+        data = np.zeros((len(bands), ny * nx))
+
         #TODO: check if a lower offset bound different from zero is needed. 
-        events = events.select_offset((Angle(0, 'deg'), p['offset_max']))
+        for pointing, ra, dec, energy in self._event_chunks(observation):
+            mask = np.zeros(len(energy), dtype=bool)
+            for emin, emax in bands:
+                mask |= (energy >= emin) & (energy < emax)
+            radec = SkyCoord(ra[mask], dec[mask], unit='deg', frame='icrs')
+            cos_offset = np.tensordot(_unit_vectors(pointing), _unit_vectors(radec), axes=1)
+            selection = cos_offset > cos_offset_max
+            x, y = wcs_image.wcs_skycoord_to_pixel(radec[selection])
+            energy = energy[mask][selection]
+
+            # same pixel bins as `SkyImage.fill_events`, NaN positions are dropped
+            inside = (x >= -0.5) & (x < nx - 0.5) & (y >= -0.5) & (y < ny - 0.5)
+            idx = np.floor(y[inside] + 0.5).astype(int) * nx + np.floor(x[inside] + 0.5).astype(int)
+            energy = energy[inside]
+            for band, (emin, emax) in enumerate(bands):
+                in_band = (energy >= emin) & (energy < emax)
+                data[band] += np.bincount(idx[in_band], minlength=ny * nx)
 
-        counts = self._get_empty_skyimage()
-        counts.fill_events(events)
-        return counts
+        images = []
+        for band, band_data in enumerate(data):
+            counts = self._get_empty_skyimage(bbox, band)
+            counts.data = band_data.reshape(ny, nx)
+            images.append(counts)
+        return images
     
-    def _background_image(self, counts, exposure):
-        p = self.parameters
+    def _background_image(self, counts, exposure, bbox=None):
+        """
+        Run the background estimator on one observation.
+        """
+        exclusion = self.exclusion_mask
+        if bbox is not None:
+            exclusion = self._cutout(exclusion, bbox)
+
         input_images = SkyImageList()
         input_images['counts'] = counts
-        exposure_on = exposure.copy()
-        exposure_on.name = 'exposure_on'
-        input_images['exposure_on'] = exposure_on
-        input_images['exclusion'] = self.exclusion_mask
-        
+        # shares the exposure data, the estimators don't modify their inputs
+        input_images['exposure_on'] = SkyImage(name='exposure_on', data=exposure.data,
+                                               wcs=exposure.wcs)
+        input_images['exclusion'] = exclusion
         return self.background_estimator.run(input_images)
-    
-    def run(self, observations):
+
+    def _ring_kernels(self):
+        """
+        Kernel arrays of a (adaptive) ring background estimator, `None` for
+        other estimators.
+        """
+        estimator = self.background_estimator
+        if isinstance(estimator, AdaptiveRingBackgroundEstimator):
+            return [_.array for _ in estimator.kernels(self.reference)]
+        elif isinstance(estimator, RingBackgroundEstimator):
+            return [estimator.kernel(self.reference).array]
+        return None
+
+    def _ring_padding(self):
+        """
+        Boundary mode of the ring convolutions of the background estimator, as
+        a `numpy.pad` mode.
+
+        The adaptive ring estimator convolves with `scipy.signal.fftconvolve`,
+        i.e. with zeros outside the image, as does the ring estimator with
+        the ``use_fft_convolution`` option (gammapy >= 0.7). Before, the ring
+        estimator used `scipy.ndimage.convolve` with reflection at the boundary.
+        """
+        estimator = self.background_estimator
+        if (isinstance(estimator, AdaptiveRingBackgroundEstimator) or
+                'use_fft_convolution' in estimator.parameters):
+            return 'constant'
+        return 'symmetric'
+
+    def _kernels_fft(self, kernels, shape):
+        """
+        FFT of the (centered, zero padded) kernels for a given FFT shape, cached.
+        """
+        key = (self.background_estimator.__class__.__name__, str(self.background_estimator.parameters),
+               shape)
+        if key not in self._kernels_fft_cache:
+            size = max(_.shape[0] for _ in kernels)
+            stack = np.array([_add_kernels(np.zeros((size, size)), _) for _ in kernels])
+            self._kernels_fft_cache[key] = np.fft.rfftn(stack, s=shape, axes=(-2, -1))
+        return self._kernels_fft_cache[key]
+
+    def _convolve_batch(self, images, kernels, mode='constant'):
+        """
+        Convolve a batch of images with a set of kernels, with FFTs on the stacked images.
+
+        Each image is padded with the `numpy.pad` ``mode`` (see `_ring_padding`)
+        and then zero padded to a common FFT shape, so that the result for
+        every image is the same as the convolution done by the background
+        estimator. The kernel FFTs are reused for every batch with the same shape.
+
+        Returns
+        -------
+        result : list of `~numpy.ndarray`
+            Convolved images, with shape ``(len(kernels), ny, nx)`` each.
+        """
+        pad = max(_.shape[0] for _ in kernels) // 2
+        shape = tuple(next_fast_len(max(_.shape[idx] for _ in images) + 4 * pad) for idx in [0, 1])
+
+        stack = np.zeros((len(images),) + shape)
+        for image, data in zip(stack, images):
+            ny, nx = data.shape
+            image[:ny + 2 * pad, :nx + 2 * pad] = np.pad(data, pad, mode=mode)
+
+        data_fft = np.fft.rfftn(stack, axes=(-2, -1))
+        kernels_fft = self._kernels_fft(kernels, shape)
+        convolved = np.fft.irfftn(data_fft[:, np.newaxis] * kernels_fft, s=shape, axes=(-2, -1))
+
+        result = []
+        for image, data in zip(convolved, images):
+            ny, nx = data.shape
+            image = image[:, 2 * pad:2 * pad + ny, 2 * pad:2 * pad + nx]
+            # remove FFT round off noise where the direct convolution is zero
+            image[np.abs(image) < 1e-10 * np.abs(data).max() * kernels[0].size] = 0
+            result.append(image)
+        return result
+
+    def _background_batch(self, counts, exposure, bboxes):
+        """
+        Background images for a batch of observations.
+
+        For the ring and adaptive ring estimators the ring convolutions of all
+        observations are done at once on the stacked cutouts (see
+        `_convolve_batch`), other estimators are run per observation.
+        """
+        kernels = self._ring_kernels()
+        if kernels is None:
+            return [self._background_image(_counts, _exposure, bbox)['background'].data
+                    for _counts, _exposure, bbox in zip(counts, exposure, bboxes)]
+
+        exclusion = [self.exclusion_mask.data if bbox is None else
+                     self._cutout(self.exclusion_mask, bbox).data for bbox in bboxes]
+        mode = self._ring_padding()
+        off = self._convolve_batch([c.data * e for c, e in zip(counts, exclusion)],
+                                   kernels, mode)
+        exposure_off = self._convolve_batch([_.data * e for _, e in zip(exposure, exclusion)],
+                                            kernels, mode)
+
+        estimator = self.background_estimator
+        result = []
+        for idx, _exposure in enumerate(exposure):
+            if isinstance(estimator, AdaptiveRingBackgroundEstimator):
+                # same selection of the ring size as `AdaptiveRingBackgroundEstimator.run`
+                cubes = OrderedDict()
+                cubes['exposure_on'] = estimator._exposure_on_cube({'exposure_on': _exposure}, kernels)
+                cubes['exposure_off'] = np.moveaxis(exposure_off[idx], 0, -1)
+                cubes['off'] = np.moveaxis(off[idx], 0, -1)
+                cubes['alpha_approx'] = estimator._alpha_approx_cube(cubes)
+                _exposure_off, _off = estimator._reduce_cubes(cubes)
+            else:
+                _exposure_off, _off = exposure_off[idx][0], off[idx][0]
+
+            with np.errstate(invalid='ignore', divide='ignore'):
+                result.append(_exposure.data / _exposure_off * _off)
+        return result
+
+    def _run_batch(self, observations):
+        """
+        Compute counts, exposure and background images for a list of observations,
+        in all energy bands.
+
+        All images are zero outside ``offset_max``. With ``cutout=True`` they
+        are computed on a cutout of the reference image, the bounding box of
+        the offset circle extended by the reach of the background estimator
+        kernel (see `_cutout_margin`), which gives the same result as
+        on the full reference image. Only the part within the bounding
+        box of the offset circle is returned. The background images of the
+        batch (all observations and energy bands) are computed together, see
+        `_background_batch`.
+
+        With ``compute_psf=True``, the PSF image of the observation times
+        its exposure is added to the kernels of the patch.
+
+        Returns
+        -------
+        patches : list of tuple
+            Bounding box, dict of images and dict of kernels for every
+            observation with pixels within ``offset_max``, see `_add_patches`.
+            Images and kernels are keyed by ``(band, name)``.
+        """
+        batch = []
+        for observation in observations:
+            pointing = observation.pointing_radec
+            bbox = self._bounding_box(pointing)
+            if bbox is None:
+                continue
+
+            if self.cutout:
+                bbox_margin = self._bounding_box(pointing, margin=self._cutout_margin())
+            else:
+                bbox_margin = None
+
+            counts = self._counts_image(observation, bbox_margin)
+            # the IRF tables are hashed once per observation, not for every
+            # cache lookup in the energy bands and PSF offset nodes
+            aeff = observation.aeff
+            aeff_key = _aeff_key(aeff)
+            exposure = self._exposure_image(observation, aeff, aeff_key, bbox_margin)
+            if self.compute_psf:
+                psf = observation.psf
+                psf_key = _psf_key(psf)
+            else:
+                psf, psf_key = None, None
+            batch.append((observation, aeff, aeff_key, psf, psf_key, bbox, bbox_margin, counts,
+                          exposure))
+
+        if not batch:
+            return []
+
+        n_bands = len(self.energy_bands)
+        counts = [_ for item in batch for _ in item[7]]
+        exposure = [_ for item in batch for _ in item[8]]
+        bboxes = [item[6] for item in batch for _ in range(n_bands)]
+        backgrounds = self._background_batch(counts, exposure, bboxes)
+
+        patches = []
+        for idx, item in enumerate(batch):
+            observation, aeff, aeff_key, psf, psf_key, bbox, bbox_margin, counts, exposure = item
+            ymin, ymax, xmin, xmax = bbox
+            if bbox_margin is not None:
+                ymin, ymax = ymin - bbox_margin[0], ymax - bbox_margin[0]
+                xmin, xmax = xmin - bbox_margin[2], xmax - bbox_margin[2]
+
+            images, kernels = OrderedDict(), OrderedDict()
+            for band in range(n_bands):
+                background = backgrounds[idx * n_bands + band]
+                images[band, 'counts'] = counts[band].data[ymin:ymax, xmin:xmax]
+                images[band, 'exposure'] = exposure[band].data[ymin:ymax, xmin:xmax]
+                images[band, 'background'] = np.nan_to_num(background[ymin:ymax, xmin:xmax])
+
+                if self.compute_psf:
+                    psf_image = self._psf_image(observation, psf, psf_key, aeff, aeff_key,
+                                                exposure[band], bbox_margin, band)
+                    kernels[band, 'psf'] = psf_image.data * psf_image.meta['exposure']
+            patches.append((bbox, images, kernels))
+        return patches
+
+    def _run_observation(self, observation):
+        """
+        Compute counts, exposure and background images for one observation,
+        see `_run_batch`.
+        """
+        patches = self._run_batch([observation])
+        return patches[0] if patches else None
+
+    def run(self, observations, n_jobs=1, batch_size=8):
         """
         Run sky image estimation.
+
+        Observations are processed in batches (see `_run_batch`), with
+        ``n_jobs > 1`` in a pool of worker processes, and the per observation
+        images are summed pairwise (see `_tree_sum`).
         
         Parameters
         ----------
         observations : `gammapy.data.ObservationList`
             List of observations
+        n_jobs : int
+            Number of worker processes, `None` for the number of CPUs.
+        batch_size : int
+            Number of observations per batch.
         
         Returns
         -------
-        sky_images : `gammapy.image.SkyImageList`
-            List of sky images.
+        sky_images : `gammapy.image.SkyImageList` or list
+            List of sky images, or one per energy band if there are several.
         """
-        result = SkyImageList()
-        result['counts'] = self._get_empty_skyimage()
-        result['exposure'] = self._get_empty_skyimage()
-        result['background'] = self._get_empty_skyimage()
-        
-        for observation in observations:
-            counts = self._counts_image(observation)
-            result['counts'].data += counts.data
-            
-            exposure = self._exposure_image(observation)
-            result['exposure'].data += exposure.data
-            
-            background = self._background_image(counts, exposure)
-            result['background'].data += np.nan_to_num(background['background'].data)
+        results = []
+        for band in range(len(self.energy_bands)):
+            result = SkyImageList()
+            result['counts'] = self._get_empty_skyimage(band=band)
+            result['exposure'] = self._get_empty_skyimage(band=band)
+            result['background'] = self._get_empty_skyimage(band=band)
+            results.append(result)
+
+        batches = _batches(observations, batch_size)
+        if n_jobs == 1:
+            patch = _tree_sum(_ for batch in batches for _ in self._run_batch(batch))
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker,
+                                     initargs=(self,)) as executor:
+                patch = _tree_sum(_ for patches in executor.map(_run_batch, batches)
+                                  for _ in patches)
+
+        if patch is not None:
+            (ymin, ymax, xmin, xmax), images, kernels = patch
+            for (band, name), data in images.items():
+                results[band][name].data[ymin:ymax, xmin:xmax] += data
+            for (band, name), data in kernels.items():
+                results[band][name] = SkyImage(name=name, data=data / data.sum())
             
-        return result
+        return results[0] if len(results) == 1 else results
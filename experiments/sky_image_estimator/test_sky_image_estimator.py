@@ -0,0 +1,264 @@
+"""Tests of `IACTSkyImageEstimator` against the wrapped gammapy estimators.
+
+python -m pytest test_sky_image_estimator.py
+"""
+import numpy as np
+from numpy.testing import assert_allclose, assert_equal
+import pytest
+from astropy import units as u
+from astropy.coordinates import Angle, SkyCoord
+from astropy.table import Table
+from astropy.wcs import WCS
+from gammapy.background import RingBackgroundEstimator, AdaptiveRingBackgroundEstimator
+from gammapy.cube import SkyCube, exposure_cube
+from gammapy.data import EventList
+from gammapy.image import SkyImage, SkyImageList, SkyMask
+from gammapy.irf import EffectiveAreaTable2D
+from sky_image_estimator import IACTSkyImageEstimator, _aeff_key, _circle
+
+OFFSET_MAX = Angle(1, 'deg')
+ENERGY_BANDS = [(1 * u.TeV, 3 * u.TeV), (3 * u.TeV, 10 * u.TeV)]
+
+
+class SyntheticObservation(object):
+    """
+    Observation with the attributes used by `IACTSkyImageEstimator`, without data store.
+    """
+    def __init__(self, events, aeff):
+        self.events = events
+        self.aeff = aeff
+
+    @property
+    def pointing_radec(self):
+        return self.events.pointing_radec
+
+    @property
+    def observation_live_time_duration(self):
+        return self.events.observation_live_time_duration
+
+
+def make_aeff(amplitude=1e5):
+    """
+    Effective area falling off with offset, with a low energy cutoff.
+    """
+    energy = np.logspace(-1, 2, 31) * u.TeV
+    offset = np.linspace(0, 3, 13) * u.deg
+    energy_center = np.sqrt(energy[1:] * energy[:-1]).to('TeV').value
+    data = (amplitude * (1 - np.exp(-energy_center / 0.3))[:, np.newaxis] *
+            (1 - (offset.value / 3.5) ** 2)[np.newaxis, :])
+    return EffectiveAreaTable2D(energy=energy, offset=offset, data=data * u.m ** 2)
+
+
+def make_observations(n_events=5000):
+    """
+    Observations around the center of the images of `make_images`, with
+    events on the energy band edges and next to the offset edge.
+
+    Events on the offset edge to rounding precision can fall on either side,
+    so they are placed at a relative distance of 1e-9 inside and outside.
+    """
+    center = SkyCoord(184.56, -5.78, unit='deg', frame='galactic').icrs
+    observations = []
+    for obs_id, (dra, ddec, amplitude) in enumerate([(0, 0, 1e5), (0.6, 0.3, 2e5),
+                                                     (-0.8, -0.5, 1e5)]):
+        pointing = SkyCoord(center.ra.deg + dra, center.dec.deg + ddec, unit='deg')
+        random_state = np.random.RandomState(obs_id)
+        ra = pointing.ra.deg + random_state.uniform(-1.5, 1.5, n_events) / np.cos(pointing.dec.rad)
+        dec = pointing.dec.deg + random_state.uniform(-1.5, 1.5, n_events)
+        energy = 10 ** random_state.uniform(-0.5, 1.5, n_events)
+        energy[:60] = np.tile([1, 3, 10], 20)
+
+        for factor, edge_energy in [(1 - 1e-9, 2), (1 + 1e-9, 5)]:
+            points = _circle(pointing, OFFSET_MAX * factor, n_points=16)
+            ra = np.append(ra, points.ra.deg)
+            dec = np.append(dec, points.dec.deg)
+            energy = np.append(energy, np.full(16, edge_energy))
+
+        table = Table([ra, dec, energy], names=['RA', 'DEC', 'ENERGY'])
+        table['ENERGY'].unit = 'TeV'
+        table.meta.update(RA_PNT=pointing.ra.deg, DEC_PNT=pointing.dec.deg, LIVETIME=1800.)
+        observations.append(SyntheticObservation(EventList(table), make_aeff(amplitude)))
+    return observations
+
+
+def make_images():
+    """
+    Counts and exposure images with sources touching the image edges.
+    """
+    reference = SkyImage.empty(nxpix=120, nypix=80, binsz=0.02, xref=184.56, yref=-5.78,
+                               coordsys='GAL', proj='CAR')
+    random_state = np.random.RandomState(0)
+    y, x = np.indices(reference.data.shape)
+
+    counts = SkyImage.empty_like(reference, name='counts')
+    counts.data = random_state.poisson(2, reference.data.shape).astype(float)
+    for x0, y0, amplitude in [(0, 0, 1e3), (60, 0, 5e2), (119, 40, 2e3), (119, 79, 1e3)]:
+        counts.data += amplitude * np.exp(-((x - x0) ** 2 + (y - y0) ** 2) / (2 * 3. ** 2))
+
+    exposure = SkyImage.empty_like(reference, name='exposure')
+    exposure.data = 1e10 * (1 + 0.5 * np.cos(x / 30.))
+
+    exclusion = SkyMask.empty_like(reference, name='exclusion', fill=1)
+    exclusion.data[30:50, 50:70] = 0
+    return reference, counts, exposure, exclusion
+
+
+@pytest.mark.parametrize('background_estimator', [
+    RingBackgroundEstimator(r_in=0.3 * u.deg, width=0.2 * u.deg),
+    AdaptiveRingBackgroundEstimator(r_in=0.2 * u.deg, r_out_max=0.6 * u.deg, width=0.1 * u.deg,
+                                    stepsize=0.1 * u.deg, threshold_alpha=0.5),
+])
+def test_background_batch(background_estimator):
+    reference, counts, exposure, exclusion = make_images()
+
+    images = SkyImageList()
+    images['counts'] = counts
+    images['exposure_on'] = SkyImage(name='exposure_on', data=exposure.data, wcs=exposure.wcs)
+    images['exclusion'] = exclusion
+    expected = background_estimator.run(images)['background'].data
+
+    estimator = IACTSkyImageEstimator(reference=reference, emin=1 * u.TeV, emax=10 * u.TeV,
+                                      background_estimator=background_estimator,
+                                      exclusion_mask=exclusion)
+    # twice the same observation, to run the stacked convolutions on a batch
+    result = estimator._background_batch([counts, counts], [exposure, exposure], [None, None])
+
+    for background in result:
+        assert_allclose(background, expected, rtol=1e-8, atol=1e-8)
+
+
+def test_counts_image():
+    reference = make_images()[0]
+    estimator = IACTSkyImageEstimator(reference=reference, emin=1 * u.TeV, emax=10 * u.TeV,
+                                      offset_max=OFFSET_MAX, energy_bands=ENERGY_BANDS)
+
+    for observation in make_observations():
+        counts = estimator._counts_image(observation)
+        for band, energy_band in enumerate(ENERGY_BANDS):
+            events = observation.events.select_energy(u.Quantity(energy_band))
+            events = events.select_offset(Angle([0, OFFSET_MAX.deg], 'deg'))
+            expected = SkyImage.empty_like(reference)
+            expected.fill_events(events)
+            assert expected.data.sum() > 0
+            assert_equal(counts[band].data, expected.data)
+
+
+def make_exposure(estimator, observation, band):
+    """
+    Exposure image of an observation in an energy band with `exposure_cube`,
+    weighted with the spectral model and integrated over the band.
+    """
+    emin, emax = estimator.energy_bands[band]
+    offset_max = estimator.parameters['offset_max']
+    cube = exposure_cube(observation.pointing_radec, observation.observation_live_time_duration,
+                         observation.aeff, estimator.ref_cube, offset_max=offset_max)
+    weights = estimator.spectral_models[band](cube.energies('center'))
+    cube = SkyCube(data=cube.data * weights.reshape(-1, 1, 1), wcs=cube.wcs,
+                   energy_axis=cube.energy_axis)
+    data = np.nan_to_num(cube.sky_image_integral(emin=emin, emax=emax).data.to('m2 s').value)
+    offset = estimator.reference.coordinates().separation(observation.pointing_radec)
+    data[offset >= offset_max] = 0
+    return data
+
+
+def test_exposure_image():
+    reference = make_images()[0]
+    estimator = IACTSkyImageEstimator(reference=reference, emin=1 * u.TeV, emax=10 * u.TeV,
+                                      offset_max=OFFSET_MAX, energy_bands=ENERGY_BANDS)
+
+    for observation in make_observations():
+        aeff = observation.aeff
+        bbox = estimator._bounding_box(observation.pointing_radec)
+        ymin, ymax, xmin, xmax = bbox
+        exposure = estimator._exposure_image(observation, aeff, _aeff_key(aeff))
+        exposure_cutout = estimator._exposure_image(observation, aeff, _aeff_key(aeff), bbox)
+
+        for band in range(len(ENERGY_BANDS)):
+            expected = make_exposure(estimator, observation, band)
+            # the profiles are interpolated linearly on the `OFFSET_STEP` grid,
+            # the effective area is piecewise linear on a 0.25 deg offset grid
+            atol = 1e-3 * expected.max()
+            assert_allclose(exposure[band].data, expected, rtol=0, atol=atol)
+            assert_allclose(exposure_cutout[band].data, expected[ymin:ymax, xmin:xmax],
+                            rtol=0, atol=atol)
+
+
+def test_exposure_cache():
+    reference = make_images()[0]
+    kwargs = dict(reference=reference, emin=1 * u.TeV, emax=10 * u.TeV, offset_max=OFFSET_MAX,
+                  energy_bands=ENERGY_BANDS)
+    uncached = IACTSkyImageEstimator(exposure_cache_size=0, **kwargs)
+    cached = IACTSkyImageEstimator(exposure_cache_size=2, **kwargs)
+
+    observations = make_observations()
+    # cache hits, evictions and cutouts of the same pointing
+    for idx, cutout in [(0, False), (1, False), (0, False), (0, True), (2, False), (1, False),
+                        (0, False), (0, True)]:
+        observation = observations[idx]
+        aeff, aeff_key = observation.aeff, _aeff_key(observation.aeff)
+        bbox = cached._bounding_box(observation.pointing_radec) if cutout else None
+
+        expected = uncached._exposure_image(observation, aeff, aeff_key, bbox)
+        for _ in range(2):
+            actual = cached._exposure_image(observation, aeff, aeff_key, bbox)
+            for band in range(len(ENERGY_BANDS)):
+                assert_equal(actual[band].data, expected[band].data)
+        assert len(cached._exposure_cache) <= 2
+
+    assert len(uncached._exposure_cache) == 0
+
+
+def make_estimator(reference, exclusion, **kwargs):
+    """
+    Estimator with a ring background on the synthetic observations.
+    """
+    kwargs.setdefault('emin', 1 * u.TeV)
+    kwargs.setdefault('emax', 10 * u.TeV)
+    background_estimator = RingBackgroundEstimator(r_in=0.3 * u.deg, width=0.2 * u.deg)
+    return IACTSkyImageEstimator(reference=reference, offset_max=OFFSET_MAX,
+                                 background_estimator=background_estimator,
+                                 exclusion_mask=exclusion, **kwargs)
+
+
+def assert_images_allclose(actual, expected):
+    assert_equal(actual['counts'].data, expected['counts'].data)
+    for name in ['exposure', 'background']:
+        assert_allclose(actual[name].data, expected[name].data, rtol=1e-6, atol=1e-12)
+
+
+def test_energy_bands():
+    reference, _, _, exclusion = make_images()
+    observations = make_observations()
+    results = make_estimator(reference, exclusion, energy_bands=ENERGY_BANDS).run(observations)
+
+    assert len(results) == len(ENERGY_BANDS)
+    for result, (emin, emax) in zip(results, ENERGY_BANDS):
+        expected = make_estimator(reference, exclusion, emin=emin, emax=emax).run(observations)
+        assert expected['counts'].data.sum() > 0
+        assert_images_allclose(result, expected)
+
+
+def test_run_parallel():
+    reference, _, _, exclusion = make_images()
+    observations = make_observations()
+    estimator = make_estimator(reference, exclusion)
+
+    expected = estimator.run(observations, n_jobs=1, batch_size=1)
+    result = estimator.run(observations, n_jobs=2, batch_size=1)
+    assert_images_allclose(result, expected)
+
+
+@pytest.mark.parametrize('cd_matrix', [False, True])
+def test_cutout(cd_matrix):
+    reference = make_images()[0]
+    if cd_matrix:
+        header = reference.wcs.to_header()
+        header['CD1_1'], header['CD2_2'] = header.pop('CDELT1'), header.pop('CDELT2')
+        reference = SkyImage(data=reference.data, wcs=WCS(header))
+    exclusion = SkyMask.empty_like(reference, fill=1)
+    exclusion.data[30:50, 50:70] = 0
+    observations = make_observations()
+
+    result = make_estimator(reference, exclusion, cutout=True).run(observations)
+    expected = make_estimator(reference, exclusion, cutout=False).run(observations)
+    assert_images_allclose(result, expected)
@@ -1,3 +1,4 @@
+from timeit import timeit
 import numpy as np
 import astropy.units as u
 from regions import CircleSkyRegion
@@ -6,9 +7,13 @@ from gammapy.data import DataStore
 from gammapy.maps import MapAxis, RegionGeom
 from gammapy.datasets import SpectrumDataset
 from gammapy.makers import SpectrumDatasetMaker, ReflectedRegionsBackgroundMaker
+from gammapy.modeling import Fit
+from gammapy.modeling.models import PowerLawSpectralModel, SkyModel
 from unbinned_datasets import (
-    UnbinnedSpectrumDatasetOnOff,
+    UnbinnedDatasetStacker,
     UnbinnedReflectedRegionsBackgroundMaker,
+    UnbinnedSpectrumDatasetOnOff,
+    make_on_off_datasets,
 )
 import matplotlib.pyplot as plt
 
@@ -36,25 +41,108 @@ dataset_maker = SpectrumDatasetMaker(
     containment_correction=True, selection=["counts", "exposure", "edisp"]
 )
 
-# binned and unbinned background makers and list to host the SpectrumDatasets
+# binned and unbinned ON OFF datasets, reduced in parallel with one
+# event list read per observation
+datasets, unbinned_datasets = make_on_off_datasets(
+    observations, dataset_empty, dataset_maker
+)
+
+# reduced in this process, the OFF regions are cached by the given maker,
+# one entry per pointing, and the result is the same
+bkg_maker_serial = UnbinnedReflectedRegionsBackgroundMaker()
+datasets_serial, _ = make_on_off_datasets(
+    observations, dataset_empty, dataset_maker, bkg_maker=bkg_maker_serial, n_jobs=1
+)
+pointings = {(obs.pointing_radec.ra.deg, obs.pointing_radec.dec.deg) for obs in observations}
+assert len(bkg_maker_serial._regions_off_cache) == len(pointings)
+regions_off, _ = bkg_maker_serial.make_regions_off(dataset_empty, observations[0])
+assert len(bkg_maker_serial._regions_off_cache) == len(pointings)
+assert regions_off is next(reversed(bkg_maker_serial._regions_off_cache.values()))[0]
+for dataset_serial, dataset_on_off in zip(datasets_serial, datasets):
+    assert np.all(dataset_serial.counts_off.data == dataset_on_off.counts_off.data)
+
+# check the combined reduction against the binned background maker
 bkg_maker = ReflectedRegionsBackgroundMaker()
-unbinned_bkg_maker = UnbinnedReflectedRegionsBackgroundMaker()
-datasets = []
-unbinned_datasets = []
 
-for observation in observations:
-    # binned datasets
+for observation, dataset_on_off, unbinned_dataset_on_off in zip(
+    observations, datasets, unbinned_datasets
+):
     dataset = dataset_maker.run(dataset_empty, observation)
-    dataset_on_off = bkg_maker.run(dataset, observation)
-    datasets.append(dataset_on_off)
-    # unbinned datasets
-    unbinned_dataset_on_off = unbinned_bkg_maker.run(dataset, observation)
-    unbinned_datasets.append(unbinned_dataset_on_off)
-    # write the unbinned to disk
-    unbinned_dataset_on_off.write(
-        f"data/obs_id_{observation.obs_id}_unbinned_spectrum.fits", overwrite=True
+    reference = bkg_maker.run(dataset, observation)
+    assert np.all(reference.counts.data == dataset_on_off.counts.data)
+    assert np.all(reference.counts_off.data == dataset_on_off.counts_off.data)
+    # write the unbinned to disk and check that the events are read back
+    filename = f"data/obs_id_{observation.obs_id}_unbinned_spectrum.fits"
+    unbinned_dataset_on_off.write(filename, overwrite=True)
+    unbinned_read = UnbinnedSpectrumDatasetOnOff.read(filename)
+    for events, events_read in zip(
+        [unbinned_dataset_on_off.events, unbinned_dataset_on_off.events_off],
+        [unbinned_read.events, unbinned_read.events_off],
+    ):
+        assert np.all(events.energy == events_read.energy)
+        assert np.all(events.time == events_read.time)
+
+# benchmark the unbinned likelihood against the binned WSTAT, for a
+# parameter change (model re-evaluated) and for repeated calls (cached)
+for observation, binned, unbinned in zip(observations, datasets, unbinned_datasets):
+    for dataset in [binned, unbinned]:
+        spectral_model = PowerLawSpectralModel(
+            index=2.5, amplitude="3e-11 cm-2 s-1 TeV-1"
+        )
+        dataset.models = [SkyModel(spectral_model=spectral_model, name="crab")]
+
+    def update():
+        for dataset in [binned, unbinned]:
+            dataset.models.parameters["index"].value += 1e-3
+
+    n = 100
+    t_binned = timeit(lambda: (update(), binned.stat_sum()), number=n) / n
+    t_unbinned = timeit(lambda: (update(), unbinned.stat_sum()), number=n) / n
+    t_cached = timeit(unbinned.stat_sum, number=n) / n
+    print(
+        f"{observation.obs_id}: {len(unbinned.events.table)} ON events, stat_sum binned "
+        f"{1e3 * t_binned:.2f} ms, unbinned {1e3 * t_unbinned:.2f} ms, "
+        f"unbinned cached {1e3 * t_cached:.2f} ms"
     )
 
+    # both likelihoods should give compatible best-fit parameters
+    for dataset in [binned, unbinned]:
+        Fit().run([dataset])
+    index, index_unbinned = [
+        _.models.parameters["index"] for _ in [binned, unbinned]
+    ]
+    assert abs(index.value - index_unbinned.value) < index.error
+
+# stack the unbinned datasets streaming from the files written above and
+# compare with the binned stacking
+stacker = UnbinnedDatasetStacker()
+for observation in observations:
+    filename = f"data/obs_id_{observation.obs_id}_unbinned_spectrum.fits"
+    stacker.stack(UnbinnedSpectrumDatasetOnOff.read(filename))
+unbinned_stacked = stacker.to_dataset()
+
+stacked = datasets[0].copy(name="stacked")
+for dataset in datasets[1:]:
+    stacked.stack(dataset)
+
+counts_off, alpha = unbinned_stacked._off_counts_and_alpha()
+assert len(unbinned_stacked.events.table) == stacked.counts.data.sum()
+assert np.all(counts_off == stacked.counts_off.data.ravel())
+assert np.allclose(alpha, stacked.alpha.data.ravel())
+
+for dataset in [stacked, unbinned_stacked]:
+    spectral_model = PowerLawSpectralModel(index=2.5, amplitude="3e-11 cm-2 s-1 TeV-1")
+    dataset.models = [SkyModel(spectral_model=spectral_model, name="crab")]
+    Fit().run([dataset])
+index, index_unbinned = [
+    _.models.parameters["index"] for _ in [stacked, unbinned_stacked]
+]
+print(
+    f"stacked: index binned {index.value:.3f} +- {index.error:.3f}, "
+    f"unbinned {index_unbinned.value:.3f} +- {index_unbinned.error:.3f}"
+)
+assert abs(index.value - index_unbinned.value) < index.error
+
 # check that the same events have been stored by checking the histograms
 # of the ON and OFF counts from the two datasets
 for binned, unbinned in zip(datasets, unbinned_datasets):
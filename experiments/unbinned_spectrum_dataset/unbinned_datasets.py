@@ -1,53 +1,666 @@
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import numpy as np
+import astropy.units as u
+from astropy.coordinates import Angle, SkyCoord
 from astropy.io import fits
-from gammapy.datasets import SpectrumDatasetOnOff
-from gammapy.makers import ReflectedRegionsFinder, ReflectedRegionsBackgroundMaker
-from gammapy.utils.regions import regions_to_compound_region
+from astropy.table import Column, Table
+from gammapy.data import GTI, EventList, Observation
+from gammapy.datasets import MapDataset, SpectrumDataset, SpectrumDatasetOnOff
+from gammapy.irf import EDispKernel, EDispKernelMap
+from gammapy.makers import ReflectedRegionsBackgroundMaker
+from gammapy.maps import RegionGeom, RegionNDMap
+from gammapy.stats import get_wstat_mu_bkg
+
+# event list columns stored by `UnbinnedSpectrumDatasetOnOff.write`
+EVENT_COLUMNS = ["ENERGY", "TIME"]
+EVENT_COLUMNS_POSITION = ["RA", "DEC"]
+# per event OFF exposure ratio, only for stacked datasets
+EVENT_COLUMN_ALPHA = "ALPHA"
+
+
+def _unit_vectors(coords):
+    """Cartesian unit vectors (N, 3) for sky coordinates."""
+    # float64 is needed, float32 can't resolve 1 - cos(r) for small regions
+    icrs = coords.icrs
+    lon, lat = icrs.ra.rad.astype(np.float64), icrs.dec.rad.astype(np.float64)
+    return np.column_stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)]
+    )
+
+
+def _bounding_circle(region, wcs=None):
+    """Center and radius of a circle containing the sky region."""
+    if hasattr(region, "center") and hasattr(region, "radius"):
+        return region.center, Angle(region.radius)
+
+    if wcs is None:
+        wcs = RegionGeom.from_regions(region).wcs
+
+    bbox = region.to_pixel(wcs).bounding_box
+    x = np.array([bbox.ixmin, bbox.ixmax, bbox.ixmin, bbox.ixmax]) - 0.5
+    y = np.array([bbox.iymin, bbox.iymin, bbox.iymax, bbox.iymax]) - 0.5
+    corners = SkyCoord.from_pixel(x, y, wcs=wcs)
+    center = SkyCoord.from_pixel(x.mean(), y.mean(), wcs=wcs)
+    return center, center.separation(corners).max()
+
+
+class EventSpatialIndex:
+    """Spatial index of an event list for fast region selection.
+
+    The event positions are converted once to unit vectors. A region
+    selection first keeps the events inside the bounding circles of the
+    regions (a single vectorised dot product with the circle centers) and
+    only tests these candidates for containment with the exact region
+    shapes, instead of testing all events.
+
+    No KD-tree is used: for multi-million event lists building it costs
+    more than the few region queries per observation save.
+
+    Parameters
+    ----------
+    events : `~gammapy.data.EventList`
+        Event list.
+    """
+
+    def __init__(self, events):
+        self.events = events
+        self._vectors = _unit_vectors(events.radec).reshape((-1, 3))
+
+    def _select_circles(self, centers, radii):
+        """Indices of events within any of the circles."""
+        cos_radius = np.cos(np.clip(radii.rad, 0, np.pi))
+        mask = np.zeros(len(self._vectors), dtype=bool)
+        for center, cos_r in zip(_unit_vectors(centers), cos_radius):
+            mask |= self._vectors @ center >= cos_r
+        return np.flatnonzero(mask)
+
+    def select_region(self, regions, wcs=None, selection=None):
+        """Select events in given regions.
+
+        Same result as `~gammapy.data.EventList.select_region`,
+        the order of the events is preserved.
+
+        Parameters
+        ----------
+        regions : `~regions.SkyRegion` or list of `~regions.SkyRegion`
+            Regions.
+        wcs : `~astropy.wcs.WCS`
+            World coordinate system transformation.
+        selection : tuple
+            Precomputed result of `make_region_selection` for the regions.
+
+        Returns
+        -------
+        events : `~gammapy.data.EventList`
+            Events in the regions.
+        """
+        if selection is None:
+            selection = make_region_selection(regions, wcs)
+
+        centers, radii, geom = selection
+        candidates = self.events.select_row_subset(self._select_circles(centers, radii))
+        return candidates.select_row_subset(geom.contains(candidates.radec))
+
+
+def make_region_selection(regions, wcs=None):
+    """Bounding circles and region geometry used by `EventSpatialIndex`.
+
+    Parameters
+    ----------
+    regions : `~regions.SkyRegion` or list of `~regions.SkyRegion`
+        Regions.
+    wcs : `~astropy.wcs.WCS`
+        World coordinate system transformation.
+
+    Returns
+    -------
+    selection : tuple
+        Circle centers (`~astropy.coordinates.SkyCoord`), radii
+        (`~astropy.coordinates.Angle`) and `~gammapy.maps.RegionGeom`.
+    """
+    if not isinstance(regions, list):
+        regions = [regions]
+
+    circles = [_bounding_circle(region, wcs) for region in regions]
+    centers = SkyCoord([_[0].icrs for _ in circles])
+    # containment is tested in pixel coordinates, the margin covers
+    # the small difference between the projected and the sky circle
+    radii = 1.01 * Angle([_[1] for _ in circles])
+    return centers, radii, RegionGeom.from_regions(regions, wcs=wcs)
+
+
+class _LazyEvents:
+    """Event list attribute that can be loaded on first access.
+
+    If a callable is assigned instead of an event list, it is called on
+    the first access and replaced by its return value.
+    """
+
+    def __set_name__(self, owner, name):
+        self.name = "_" + name
+
+    def __get__(self, instance, objtype=None):
+        if instance is None:
+            return self
+        value = getattr(instance, self.name)
+        if callable(value):
+            value = value()
+            setattr(instance, self.name, value)
+        return value
+
+    def __set__(self, instance, value):
+        setattr(instance, self.name, value)
+
+
+def _events_to_hdu(events, name, acceptance, position=True):
+    """Column-oriented binary table with the events needed for fitting.
+
+    The table has a single row and each column holds all events as one
+    vector cell, so that each column is stored contiguously in the file.
+    """
+    columns = EVENT_COLUMNS + EVENT_COLUMNS_POSITION if position else EVENT_COLUMNS
+    if events is not None and EVENT_COLUMN_ALPHA in events.table.colnames:
+        columns = columns + [EVENT_COLUMN_ALPHA]
+    n_events = 0 if events is None else len(events.table)
+    # astropy can't represent vector cells of length zero or one as
+    # arrays, the cells are padded and NEVENTS gives the actual length
+    repeat = max(n_events, 2)
+
+    fits_columns = []
+    for colname in columns:
+        if events is None:
+            data, unit = np.zeros(0), None
+        else:
+            column = events.table[colname]
+            data, unit = np.asarray(column), column.unit
+        is_double = colname in ["TIME", EVENT_COLUMN_ALPHA]
+        data = data.astype(np.float64 if is_double else np.float32)
+        cell = np.zeros((1, repeat), dtype=data.dtype)
+        cell[0, :n_events] = data
+        fits_format = "D" if data.dtype == np.float64 else "E"
+        fits_columns.append(
+            fits.Column(
+                name=colname,
+                format=f"{repeat}{fits_format}",
+                unit=None if unit is None else str(unit),
+                array=cell,
+            )
+        )
+
+    hdu = fits.BinTableHDU.from_columns(fits_columns, name=name)
+    if events is not None:
+        for key, value in events.table.meta.items():
+            if key not in ["EXTNAME", "comments"] and np.isscalar(value):
+                hdu.header[key] = value
+    hdu.header["NEVENTS"] = n_events, "Number of events"
+    hdu.header["ACC"] = acceptance
+    return hdu
+
+
+def _read_events(filename, hdu):
+    """Read events from a column-oriented table, memory-mapping the columns."""
+    with fits.open(filename, memmap=True) as hdulist:
+        header = hdulist[hdu].header
+        n_events = header["NEVENTS"]
+        if n_events == 0 and header["ACC"] == 0:
+            return None
+
+        data = hdulist[hdu].data
+        table = Table(meta=dict(header.copy(strip=True)))
+        for column in hdulist[hdu].columns:
+            # views on the memory-mapped file, nothing is read here
+            table[column.name] = Column(
+                data[column.name][0][:n_events], unit=column.unit, copy=False
+            )
+
+    return EventList(table)
 
 
 class UnbinnedSpectrumDatasetOnOff(SpectrumDatasetOnOff):
     """The UnbinnedSpectrumDatasetOnOff has the events and events_off 
-    attritubutes compared to the SpectrumDatasetOnOff from which it inherits."""
+    attritubutes compared to the SpectrumDatasetOnOff from which it inherits.
+
+    ``events`` and ``events_off`` can also be given as callables returning
+    the event lists, they are then loaded on first access (see `read`).
+    """
+
+    events = _LazyEvents()
+    events_off = _LazyEvents()
 
     def __init__(self, events, events_off, **kwargs):
         self.events = events
         self.events_off = events_off
         super().__init__(**kwargs)
 
-    def write(self, datapath, overwrite):
-        """write the ON / OFF event lists and the IRFs in a single HDUList"""
-        hdu = fits.BinTableHDU(self.events.table)
-        hdu_off = fits.BinTableHDU(self.events_off.table)
+    @property
+    def _geom(self):
+        """Main analysis geometry, the ON counts are not binned"""
+        return MapDataset._geom.fget(self)
+
+    def _bin_array(self, value):
+        """Per energy bin array for a scalar or a region map."""
+        data = getattr(value, "data", value)
+        n_bins = self._geom.axes["energy"].nbin
+        return np.broadcast_to(np.ravel(np.asarray(data, dtype=np.float64)), (n_bins,))
+
+    def _event_bins(self, events):
+        """Event energies and reco energy bin indices, cached per event list.
+
+        Events outside the energy axis get the index -1.
+        """
+        cache = self.__dict__.setdefault("_event_bins_cache", {})
+        key = id(events)
+        if key not in cache or cache[key][0] is not events:
+            axis = self._geom.axes["energy"]
+            energy = events.energy.to_value(axis.unit)
+            idx = np.searchsorted(axis.edges.to_value(axis.unit), energy) - 1
+            idx[(idx < 0) | (idx >= axis.nbin)] = -1
+            cache[key] = (events, energy, idx)
+        return cache[key][1:]
+
+    def _npred_signal_array(self):
+        """Predicted signal counts per reco energy bin.
+
+        The IRF-folded prediction is cached and only recomputed when
+        a model parameter value changes.
+        """
+        n_bins = self._geom.axes["energy"].nbin
+        if self.models is None or len(self.models) == 0:
+            return np.zeros(n_bins)
+
+        key = (tuple(self.models.names), tuple(self.models.parameters.value))
+        cached = self.__dict__.get("_npred_signal_cache")
+        if cached is None or cached[0] != key:
+            cached = (key, self.npred_signal().data.reshape(n_bins))
+            self._npred_signal_cache = cached
+        return cached[1]
+
+    def _off_counts_and_alpha(self):
+        """OFF counts and exposure ratio alpha per reco energy bin.
+
+        Alpha is zero where there is no OFF acceptance. For stacked datasets
+        (see `UnbinnedDatasetStacker`) the OFF events carry their own alpha,
+        which is averaged per bin as in the binned stacking, bins without
+        OFF events get the average over all OFF events.
+        """
+        n_bins = self._geom.axes["energy"].nbin
+        counts_off = np.zeros(n_bins)
+        if self.events_off is not None:
+            _, idx = self._event_bins(self.events_off)
+            valid = idx >= 0
+            counts_off = np.bincount(idx[valid], minlength=n_bins).astype(float)
+
+            table = self.events_off.table
+            if EVENT_COLUMN_ALPHA in table.colnames:
+                weights = np.asarray(table[EVENT_COLUMN_ALPHA], dtype=np.float64)
+                total_alpha = np.bincount(
+                    idx[valid], weights=weights[valid], minlength=n_bins
+                )
+                if counts_off.sum() == 0:
+                    return counts_off, np.zeros(n_bins)
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    alpha = np.where(
+                        counts_off > 0,
+                        total_alpha / counts_off,
+                        total_alpha.sum() / counts_off.sum(),
+                    )
+                return counts_off, alpha
+
+        acceptance = self._bin_array(self.acceptance)
+        acceptance_off = self._bin_array(self.acceptance_off)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            alpha = np.where(acceptance_off > 0, acceptance / acceptance_off, 0)
+        return counts_off, alpha
+
+    def _signal_density(self, mu_sig, energy):
+        """Predicted signal per unit energy at the event energies.
+
+        Log-log interpolation of the binned prediction between the bin
+        centers, evaluated for all events in a single vectorised call.
+        """
+        axis = self._geom.axes["energy"]
+        density = mu_sig / axis.bin_width.to_value(axis.unit)
+        log_density = np.log(np.clip(density, np.finfo(float).tiny, None))
+        log_center = np.log(axis.center.to_value(axis.unit))
+        return np.exp(np.interp(np.log(energy), log_center, log_density))
+
+    def stat_sum(self):
+        """Unbinned ON / OFF likelihood given the current model parameters.
+
+        Same as WSTAT, with the ON term ``-n_on log(mu_sig + alpha mu_bkg)``
+        of each bin replaced by the sum over the ON events of
+        ``-log(s(E) + b(E))``, with ``s`` the interpolated signal density
+        (see `_signal_density`) and ``b`` the WSTAT profile background,
+        constant within each bin. The background is profiled per bin, so
+        the OFF events are binned.
+        """
+        axis = self._geom.axes["energy"]
+        mask = np.ones(axis.nbin, dtype=bool)
+        if self.mask is not None:
+            mask = self.mask.data.reshape(axis.nbin).astype(bool)
+
+        energy, idx = self._event_bins(self.events)
+        selected = idx >= 0
+        selected[selected] = mask[idx[selected]]
+        energy, idx = energy[selected], idx[selected]
+
+        mu_sig = self._npred_signal_array()
+        counts = np.bincount(idx, minlength=axis.nbin)
+        counts_off, alpha = self._off_counts_and_alpha()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mu_bkg = get_wstat_mu_bkg(counts, counts_off, alpha, mu_sig)
+        mu_bkg = np.where(alpha > 0, np.nan_to_num(mu_bkg), 0)
+
+        # log only where there are OFF counts, mu_bkg is zero elsewhere
+        with np.errstate(divide="ignore"):
+            log_mu_bkg = np.log(mu_bkg, where=counts_off > 0, out=np.zeros_like(mu_bkg))
+        term_off = counts_off * log_mu_bkg
+        term_bins = mu_sig + (1 + alpha) * mu_bkg - term_off
+
+        bkg_density = alpha * mu_bkg / axis.bin_width.to_value(axis.unit)
+        density = self._signal_density(mu_sig, energy) + bkg_density[idx]
+        term_events = -np.log(density).sum()
+
+        return 2 * (term_bins[mask].sum() + term_events)
+
+    def write(self, datapath, overwrite=False, position=True):
+        """Write the ON / OFF event lists and the IRFs in a single HDUList
+
+        The events are written column-oriented to the ``EVENTS_ON`` and
+        ``EVENTS_OFF`` HDUs, with only the columns used for fitting
+        (``ENERGY``, ``TIME`` and with ``position=True`` also ``RA``, ``DEC``).
+        The file is not compressed, so that `read` can memory-map the events.
+
+        Parameters
+        ----------
+        datapath : str or `~pathlib.Path`
+            Output file name.
+        overwrite : bool
+            Overwrite existing file.
+        position : bool
+            Store the event positions.
+        """
+        hdu_primary = fits.PrimaryHDU()
+        if self.name:
+            hdu_primary.header["NAME"] = self.name
         # add the ON and OFF acceptances on the respective header of the events
         # acceptance and acceptance_off are arrays in SpectrumDatasetOnOff
-        hdu.header["ACC"] = self.acceptance
-        hdu_off.header["ACC"] = self.acceptance_off
+        hdu = _events_to_hdu(self.events, "EVENTS_ON", self.acceptance, position)
+        hdu_off = _events_to_hdu(
+            self.events_off, "EVENTS_OFF", self.acceptance_off, position
+        )
         # the effective area can be dumped directly in a HDU table
-        # self.exposure.geom.axes["energy_true"]._name = "energy"
-        aeff = self.exposure / self.exposure.meta["livetime"]
+        livetime = self.exposure.meta["livetime"]
+        aeff = self.exposure / livetime
         hdu_aeff = aeff.to_hdulist(format="ogip-arf")[1]
-        # we'll use the primary of the edisp hdulist for the final hdu_list
+        hdu_aeff.header["LIVETIME"] = livetime.to_value("s"), "Livetime (s)"
         hdu_edisp = self.edisp.get_edisp_kernel().to_hdulist()
         hdu_list = fits.HDUList(
-            [hdu_edisp[0], hdu, hdu_off, hdu_aeff, hdu_edisp[1], hdu_edisp[2]]
+            [hdu_primary, hdu, hdu_off, hdu_aeff, hdu_edisp[1], hdu_edisp[2]]
         )
+        if self.mask_safe is not None:
+            hdu_list.extend(self.mask_safe.to_hdulist(hdu="MASK_SAFE")[1:])
+        if self.gti is not None:
+            hdu_list.append(fits.BinTableHDU(self.gti.table, name="GTI"))
         hdu_list.writeto(datapath, overwrite=overwrite)
 
+    @classmethod
+    def read(cls, filename, lazy=True):
+        """Read dataset written with `write`.
+
+        The IRFs are read directly, the events are memory-mapped and with
+        ``lazy=True`` only on first access of ``events`` or ``events_off``.
+
+        Parameters
+        ----------
+        filename : str or `~pathlib.Path`
+            File name.
+        lazy : bool
+            Defer reading the events.
+
+        Returns
+        -------
+        dataset : `UnbinnedSpectrumDatasetOnOff`
+            Unbinned ON OFF dataset.
+        """
+        with fits.open(filename, memmap=True) as hdulist:
+            name = hdulist["PRIMARY"].header.get("NAME")
+            acceptance = hdulist["EVENTS_ON"].header["ACC"]
+            acceptance_off = hdulist["EVENTS_OFF"].header["ACC"]
+
+            livetime = hdulist["SPECRESP"].header["LIVETIME"] * u.s
+            aeff = RegionNDMap.from_hdulist(hdulist, format="ogip-arf")
+            exposure = aeff * livetime
+            exposure.meta["livetime"] = livetime
+
+            kernel = EDispKernel.from_hdulist(hdulist)
+            edisp = EDispKernelMap.from_edisp_kernel(kernel, geom=exposure.geom)
+            edisp.exposure_map.data = exposure.data[:, :, np.newaxis, :]
+
+            mask_safe, gti = None, None
+            if "MASK_SAFE" in hdulist:
+                mask_safe = RegionNDMap.from_hdulist(hdulist, hdu="MASK_SAFE")
+            if "GTI" in hdulist:
+                gti = GTI(Table.read(hdulist["GTI"]))
+
+        events = partial(_read_events, filename, "EVENTS_ON")
+        events_off = partial(_read_events, filename, "EVENTS_OFF")
+        if not lazy:
+            events, events_off = events(), events_off()
+
+        return cls(
+            events=events,
+            events_off=events_off,
+            exposure=exposure,
+            edisp=edisp,
+            mask_safe=mask_safe,
+            acceptance=acceptance,
+            acceptance_off=acceptance_off,
+            name=name,
+            gti=gti,
+        )
+
+
+class UnbinnedDatasetStacker:
+    """Stack unbinned ON OFF datasets one at a time.
+
+    The event columns are appended to preallocated buffers, which grow by
+    doubling, so that only the buffers and the dataset being stacked are
+    held in memory. Combined with lazily read datasets (see
+    `UnbinnedSpectrumDatasetOnOff.read`) this allows to stack large run
+    lists::
+
+        stacker = UnbinnedDatasetStacker()
+        for filename in filenames:
+            stacker.stack(UnbinnedSpectrumDatasetOnOff.read(filename))
+        stacked = stacker.to_dataset()
+
+    As for the binned stacking, events outside the safe mask of their
+    dataset are dropped and exposure, energy dispersion, safe mask and GTI
+    are stacked with `~gammapy.datasets.MapDataset.stack`. Each OFF event
+    keeps the exposure ratio alpha of its dataset in an ``ALPHA`` column,
+    which is used by `UnbinnedSpectrumDatasetOnOff.stat_sum`.
+
+    Parameters
+    ----------
+    capacity : int
+        Initial buffer size (number of events).
+    position : bool
+        Stack the event positions.
+    """
+
+    def __init__(self, capacity=100000, position=True):
+        self.capacity = capacity
+        self.columns = EVENT_COLUMNS + EVENT_COLUMNS_POSITION if position else EVENT_COLUMNS
+        self._buffers = {"events": {}, "events_off": {}}
+        self._n_events = {"events": 0, "events_off": 0}
+        self._units = {}
+        self._meta = None
+        self._time_ref = None
+        self._stacked = None
+
+    def _append(self, key, columns):
+        """Append columns (dict of arrays) to the buffers."""
+        buffers = self._buffers[key]
+        n_start = self._n_events[key]
+        n_stop = n_start + len(next(iter(columns.values())))
+
+        for name, values in columns.items():
+            buffer = buffers.get(name)
+            if buffer is None:
+                buffer = np.empty(max(self.capacity, n_stop), dtype=values.dtype)
+            elif len(buffer) < n_stop:
+                grown = np.empty(max(2 * len(buffer), n_stop), dtype=buffer.dtype)
+                grown[:n_start] = buffer[:n_start]
+                buffer = grown
+            buffer[n_start:n_stop] = values
+            buffers[name] = buffer
+
+        self._n_events[key] = n_stop
+
+    def _columns(self, dataset, events, mask):
+        """Event columns inside the safe mask, in the stacked units and time reference.
+
+        Returns the columns and the bin index of the selected events.
+        """
+        _, idx = dataset._event_bins(events)
+        selected = idx >= 0
+        selected[selected] = mask[idx[selected]]
+
+        columns = {}
+        for name in self.columns:
+            column = events.table[name]
+            values = np.asarray(column)[selected]
+            if column.unit is not None and column.unit != self._units[name]:
+                values = (values * column.unit).to_value(self._units[name])
+            columns[name] = values.astype(np.float64 if name == "TIME" else np.float32)
+
+        columns["TIME"] += (events.time_ref - self._time_ref).to_value("s")
+
+        if EVENT_COLUMN_ALPHA in events.table.colnames:
+            alpha = np.asarray(events.table[EVENT_COLUMN_ALPHA])[selected]
+            columns[EVENT_COLUMN_ALPHA] = alpha.astype(np.float64)
+        return columns, idx[selected]
+
+    def stack(self, dataset):
+        """Stack dataset.
+
+        Parameters
+        ----------
+        dataset : `UnbinnedSpectrumDatasetOnOff`
+            Dataset to stack.
+        """
+        if self._stacked is None:
+            self._stacked = SpectrumDataset.from_geoms(**dataset.geoms, name="stacked")
+            table = dataset.events.table
+            self._units = {name: table[name].unit for name in self.columns}
+            self._time_ref = dataset.events.time_ref
+            self._meta = {
+                key: table.meta[key]
+                for key in ["MJDREFI", "MJDREFF", "TIMEUNIT", "TIMESYS", "TIMEREF"]
+                if key in table.meta
+            }
+
+        n_bins = dataset._geom.axes["energy"].nbin
+        mask = np.ones(n_bins, dtype=bool)
+        if dataset.mask_safe is not None:
+            mask = dataset.mask_safe.data.reshape(n_bins).astype(bool)
+
+        columns, _ = self._columns(dataset, dataset.events, mask)
+        self._append("events", columns)
+
+        if dataset.events_off is not None:
+            columns, idx = self._columns(dataset, dataset.events_off, mask)
+            if EVENT_COLUMN_ALPHA not in columns:
+                acceptance = dataset._bin_array(dataset.acceptance)
+                acceptance_off = dataset._bin_array(dataset.acceptance_off)
+                columns[EVENT_COLUMN_ALPHA] = (acceptance / acceptance_off)[idx]
+            self._append("events_off", columns)
+
+        irfs = SpectrumDataset(
+            exposure=dataset.exposure,
+            edisp=dataset.edisp,
+            mask_safe=dataset.mask_safe,
+            gti=dataset.gti,
+        )
+        self._stacked.stack(irfs)
+
+    def _events(self, key):
+        """Event list from the filled part of the buffers."""
+        n_events = self._n_events[key]
+        table = Table(meta=dict(self._meta))
+        for name, buffer in self._buffers[key].items():
+            table[name] = Column(buffer[:n_events], unit=self._units.get(name))
+        return EventList(table)
+
+    def to_dataset(self, name="stacked"):
+        """Stacked dataset.
+
+        Parameters
+        ----------
+        name : str
+            Dataset name.
+
+        Returns
+        -------
+        dataset : `UnbinnedSpectrumDatasetOnOff`
+            Stacked unbinned ON OFF dataset.
+        """
+        if self._stacked is None:
+            raise ValueError("No dataset stacked.")
+
+        events_off, acceptance_off = None, 0
+        if self._n_events["events_off"] > 0:
+            events_off = self._events("events_off")
+            alpha = events_off.table[EVENT_COLUMN_ALPHA]
+            acceptance_off = 1 / np.mean(alpha)
+
+        return UnbinnedSpectrumDatasetOnOff(
+            events=self._events("events"),
+            events_off=events_off,
+            exposure=self._stacked.exposure,
+            edisp=self._stacked.edisp,
+            mask_safe=self._stacked.mask_safe,
+            acceptance=1,
+            acceptance_off=acceptance_off,
+            name=name,
+            gti=self._stacked.gti,
+        )
+
 
 class UnbinnedReflectedRegionsBackgroundMaker(ReflectedRegionsBackgroundMaker):
     """Inheriting from ReflectedRegionsBackgroundMaker and
     adding functions to generate list of events in the ON and OFF region"""
 
-    def __init__(self, finder=None):
+    def __init__(self, finder=None, exclusion_mask=None, cache_size=128):
         """Initialiser
 
         Parameters
         ----------
         finder : ~`gammapy.makers.RegionsFinder`
             finder to be used to extract the OFF counts
+        exclusion_mask : `~gammapy.maps.WcsNDMap`, optional
+            Exclusion mask
+        cache_size : int
+            Number of OFF region sets kept in the cache, see `make_regions_off`
         """
-        if finder is None:
-            self.finder = ReflectedRegionsFinder()
+        super().__init__(region_finder=finder, exclusion_mask=exclusion_mask)
+        self.finder = self.region_finder
+        self.cache_size = cache_size
+        self._regions_off_cache = OrderedDict()
+        self._event_index = None
+
+    def get_event_index(self, observation):
+        """Spatial index of the observation events.
+
+        The index is kept for the last observation, so that the ON and OFF
+        extraction share one event list read and one index build.
+        """
+        if self._event_index is None or self._event_index[0] != observation.obs_id:
+            self._event_index = (observation.obs_id, EventSpatialIndex(observation.events))
+        return self._event_index[1]
 
     def make_events(self, dataset, observation):
         """Make list of ON events.
@@ -67,10 +680,68 @@ class UnbinnedReflectedRegionsBackgroundMaker(ReflectedRegionsBackgroundMaker):
         """
         # the on region is stored in the Counts of the SpectrumDatasetOnOff
         region = dataset.counts.geom.region
-        # wcs = SpectrumDatasetMaker.geom_ref(region).wcs
-        events = observation.events.select_region(region)  # , wcs)
+        events = self.get_event_index(observation).select_region(
+            region, wcs=dataset.counts.geom.wcs
+        )
         return events
 
+    @staticmethod
+    def _regions_off_key(region, pointing, exclusion_mask):
+        """Cache key, pointing rounded to 1e-6 deg (< 0.01 arcsec)."""
+        pointing = pointing.icrs
+        return (
+            repr(region),
+            round(pointing.ra.deg, 6),
+            round(pointing.dec.deg, 6),
+            id(exclusion_mask),
+        )
+
+    def make_regions_off(self, dataset, observation):
+        """Make reflected OFF regions.
+
+        Many observations share the same pointing (e.g. wobble positions),
+        so the OFF regions are cached by (ON region, pointing, exclusion
+        mask), with least recently used eviction. The exclusion mask is
+        identified by object, it must not be modified in place. The cache
+        belongs to the maker instance, so it is only reused across
+        observations reduced in the same process, e.g. by
+        `make_on_off_datasets` with ``n_jobs=1``.
+
+        Parameters
+        ----------
+        dataset : `UnbinnedSpectrumDataset`
+            Spectrum dataset.
+        observation : `DatastoreObservation`
+            Data store observation.
+
+        Returns
+        -------
+        regions : list of `~regions.SkyRegion`
+            OFF regions.
+        wcs : `~astropy.wcs.WCS`
+            WCS used to define the OFF regions.
+        """
+        return self._make_regions_off(dataset, observation)[:2]
+
+    def _make_regions_off(self, dataset, observation):
+        """OFF regions, WCS and event selection (see `make_region_selection`)."""
+        region, center = dataset._geom.region, observation.pointing_radec
+        key = self._regions_off_key(region, center, self.exclusion_mask)
+
+        if key in self._regions_off_cache:
+            self._regions_off_cache.move_to_end(key)
+            return self._regions_off_cache[key]
+
+        regions, wcs = self.finder.run(
+            region=region, center=center, exclusion_mask=self.exclusion_mask
+        )
+        selection = make_region_selection(regions, wcs) if len(regions) > 0 else None
+
+        self._regions_off_cache[key] = regions, wcs, selection
+        if len(self._regions_off_cache) > self.cache_size:
+            self._regions_off_cache.popitem(last=False)
+        return regions, wcs, selection
+
     def make_events_off(self, dataset, observation):
         """Make list of OFF events.
 
@@ -88,21 +759,77 @@ class UnbinnedReflectedRegionsBackgroundMaker(ReflectedRegionsBackgroundMaker):
         acceptance_off : int
             number of OFF regions used
         """
-        regions, wcs = self.finder.run(
-            region=dataset._geom.region, center=observation.pointing_radec
-        )
+        regions, wcs, selection = self._make_regions_off(dataset, observation)
 
         if len(regions) > 0:
-            region_union = regions_to_compound_region(regions)
-            events_off = observation.events.select_region(region_union, wcs)
+            events_off = self.get_event_index(observation).select_region(
+                regions, wcs, selection=selection
+            )
             acceptance_off = len(regions)
         else:
             # if no OFF regions are found, off is set to None and acceptance_off to zero
-            counts_off = None
+            events_off = None
             acceptance_off = 0
 
         return events_off, acceptance_off
 
+    def make_counts_off(self, dataset, observation):
+        """Make binned OFF counts, from the same events as `make_events_off`.
+
+        Used by `~gammapy.makers.ReflectedRegionsBackgroundMaker.run`, so that
+        the binned ON OFF dataset is also made from the spatial event index.
+
+        Parameters
+        ----------
+        dataset : `SpectrumDataset`
+            Spectrum dataset.
+        observation : `DatastoreObservation`
+            Data store observation.
+
+        Returns
+        -------
+        counts_off : `~gammapy.maps.RegionNDMap`
+            Counts vs estimated energy extracted from the OFF regions.
+        acceptance_off : `~gammapy.maps.RegionNDMap`
+            Number of OFF regions.
+        """
+        geom = dataset.counts.geom
+        regions, wcs, selection = self._make_regions_off(dataset, observation)
+
+        if len(regions) == 0:
+            return None, RegionNDMap.from_geom(geom=geom, data=0)
+
+        events_off = self.get_event_index(observation).select_region(
+            regions, wcs, selection=selection
+        )
+        geom_off = RegionGeom.from_regions(
+            regions=regions, axes=[geom.axes["energy"]], wcs=wcs
+        )
+        counts_off = RegionNDMap.from_geom(geom=geom_off)
+        counts_off.fill_events(events_off)
+        acceptance_off = RegionNDMap.from_geom(geom=geom_off, data=len(regions))
+        return counts_off, acceptance_off
+
+    def run_on_off(self, dataset, observation):
+        """Make binned and unbinned ON OFF datasets from one event list read.
+
+        Parameters
+        ----------
+        dataset : `SpectrumDataset`
+            Spectrum dataset.
+        observation : `DatastoreObservation`
+            Data store observation.
+
+        Returns
+        -------
+        dataset_on_off : `~gammapy.datasets.SpectrumDatasetOnOff`
+            Binned ON OFF dataset.
+        unbinned_dataset_on_off : `UnbinnedSpectrumDatasetOnOff`
+            Unbinned ON OFF dataset.
+        """
+        dataset_on_off = ReflectedRegionsBackgroundMaker.run(self, dataset, observation)
+        return dataset_on_off, self.run(dataset, observation)
+
     def run(self, dataset, observation):
         """Run reflected regions background maker
 
@@ -133,3 +860,66 @@ class UnbinnedReflectedRegionsBackgroundMaker(ReflectedRegionsBackgroundMaker):
             name="",
             gti=dataset.gti,
         )
+
+
+def _make_on_off(dataset, observation, dataset_maker, bkg_maker):
+    """Reduce one observation, see `make_on_off_datasets`."""
+    # the events (and IRFs) are read again on every access of a data store
+    # observation, so both makers get an in memory copy holding them
+    observation = Observation(
+        obs_id=observation.obs_id,
+        gti=observation.gti,
+        events=observation.events,
+        **{name: getattr(observation, name) for name in observation.available_irfs},
+    )
+    dataset = dataset_maker.run(dataset, observation)
+    return bkg_maker.run_on_off(dataset, observation)
+
+
+def make_on_off_datasets(observations, dataset, dataset_maker, bkg_maker=None, n_jobs=None):
+    """Make binned and unbinned ON OFF datasets for a list of observations.
+
+    Each event list is read once and shared by the dataset maker and the
+    binned and unbinned background extraction. Observations are reduced in
+    parallel, one process per observation. Each process gets a copy of
+    ``bkg_maker``, so its OFF region cache (see
+    `UnbinnedReflectedRegionsBackgroundMaker.make_regions_off`) is only
+    shared between observations with ``n_jobs=1``, where the observations
+    are reduced in this process, one after the other.
+
+    Parameters
+    ----------
+    observations : `~gammapy.data.Observations`
+        Observations.
+    dataset : `~gammapy.datasets.SpectrumDataset`
+        Empty reference dataset.
+    dataset_maker : `~gammapy.makers.SpectrumDatasetMaker`
+        Dataset maker.
+    bkg_maker : `UnbinnedReflectedRegionsBackgroundMaker`
+        Background maker, by default with a `~gammapy.makers.ReflectedRegionsFinder`.
+    n_jobs : int
+        Number of processes, by default the number of CPUs. With ``n_jobs=1``
+        no process pool is used.
+
+    Returns
+    -------
+    datasets : list of `~gammapy.datasets.SpectrumDatasetOnOff`
+        Binned ON OFF datasets.
+    unbinned_datasets : list of `UnbinnedSpectrumDatasetOnOff`
+        Unbinned ON OFF datasets, in the same order.
+    """
+    if bkg_maker is None:
+        bkg_maker = UnbinnedReflectedRegionsBackgroundMaker()
+
+    make_on_off = partial(
+        _make_on_off, dataset, dataset_maker=dataset_maker, bkg_maker=bkg_maker
+    )
+    if n_jobs == 1:
+        results = [make_on_off(observation) for observation in observations]
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            results = list(executor.map(make_on_off, observations))
+
+    datasets = [_[0] for _ in results]
+    unbinned_datasets = [_[1] for _ in results]
+    return datasets, unbinned_datasets